@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+模拟 HLS 服务器（基准测试用）
+提供上游 m3u 列表、Master/媒体播放列表和合成的 MPEG-TS 分片，每条流按种子生成固定的画像：
+延迟、带宽、失效/偶发错误、停更、纯音频、分辨率、是否 Master Playlist
+
+路由:
+    /upstream/{k}.m3u              第 k 个上游列表（流按序号轮流分配）
+    /s/{id}/master.m3u8            Master Playlist（有 Master 画像的流）
+    /s/{id}/index.m3u8             直播媒体播放列表，序号随时间推进
+    /s/{id}/{seq}.ts               TS 分片（按带宽限速，--host-kbps 时同一源站的所有分片下载共享带宽上限）
+    /s/{id}/{h}p/index.m3u8        --ladder 时 Master 中各变体的媒体播放列表（分片为 {h}p）
+    /stats                         各类请求计数（JSON）
+
+同时监听 --hosts 个连续端口，流按序号分配到不同端口，模拟多个源站（客户端按 host:port 区分主机）；
+--dead-hosts 个（最后几个端口）源站接受连接但从不响应流请求，模拟宕机的运营商主机
+
+用法: python benchmark/hls_mock.py [--port 18765] [--hosts 50] [--streams 1000] [--upstreams 10] ...
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from aiohttp import web
+
+# 上游列表中的频道名写法，覆盖常见变体
+ChannelNames = [f"CCTV{i}" for i in range(1, 18)] + ["CCTV5+"]
+NameStyles = ["{}", "{} 高清", "{}-HD", "{}[1080p]"]
+
+# --ladder 时各变体声明的 BANDWIDTH（bit/s）
+LadderBandwidth = {2160: 16000000, 1080: 6000000, 720: 3000000, 576: 1800000, 480: 1200000}
+
+
+class BitWriter:
+    """按位写入，用于构造 SPS"""
+
+    def __init__(self):
+        self.bits = []
+
+    def U(self, n, value):
+        self.bits += [(value >> (n - 1 - i)) & 1 for i in range(n)]
+
+    def Ue(self, value):
+        value += 1
+        n = value.bit_length()
+        self.U(n - 1, 0)
+        self.U(n, value)
+
+    def Bytes(self):
+        bits = self.bits + [1]
+        bits += [0] * ((8 - len(bits) % 8) % 8)
+        return bytes(int("".join(map(str, bits[i:i + 8])), 2) for i in range(0, len(bits), 8))
+
+
+def H264Sps(width, height):
+    """生成 High Profile 逐行 H.264 SPS（含裁剪），返回带 NAL 头的字节"""
+    w = BitWriter()
+    w.U(8, 100)  # profile_idc
+    w.U(8, 0)
+    w.U(8, 40)  # level_idc
+    w.Ue(0)  # seq_parameter_set_id
+    w.Ue(1)  # chroma_format_idc
+    w.Ue(0)
+    w.Ue(0)
+    w.U(1, 0)
+    w.U(1, 0)  # seq_scaling_matrix_present_flag
+    w.Ue(0)  # log2_max_frame_num_minus4
+    w.Ue(0)  # pic_order_cnt_type
+    w.Ue(4)  # log2_max_pic_order_cnt_lsb_minus4
+    w.Ue(4)  # max_num_ref_frames
+    w.U(1, 0)
+    mbHeight = (height + 15) // 16
+    w.Ue(width // 16 - 1)
+    w.Ue(mbHeight - 1)
+    w.U(1, 1)  # frame_mbs_only_flag
+    w.U(1, 1)  # direct_8x8_inference_flag
+    coded = mbHeight * 16
+    if coded != height:
+        w.U(1, 1)
+        w.Ue(0)
+        w.Ue(0)
+        w.Ue(0)
+        w.Ue((coded - height) // 2)
+    else:
+        w.U(1, 0)
+    w.U(1, 0)  # vui_parameters_present_flag
+    nal = b"\x67" + w.Bytes()
+    # 防竞争字节
+    out = bytearray()
+    zeros = 0
+    for b in nal:
+        if zeros >= 2 and b <= 3:
+            out.append(3)
+            zeros = 0
+        out.append(b)
+        zeros = zeros + 1 if b == 0 else 0
+    return bytes(out)
+
+
+def TsPacket(pid, payload, pusi):
+    """打包一个 188 字节 TS 包，不足时用适配域填充"""
+    flag = 0x40 if pusi else 0
+    body = payload[:184]
+    if len(body) == 184:
+        return bytes([0x47, flag | (pid >> 8), pid & 0xFF, 0x10]) + body
+    stuff = 184 - len(body)
+    af = bytes([stuff - 1]) + (b"\x00" + b"\xff" * (stuff - 2) if stuff > 1 else b"")
+    return bytes([0x47, flag | (pid >> 8), pid & 0xFF, 0x30]) + af + body
+
+
+def PsiSection(tableId, body):
+    length = len(body) + 9
+    return bytes([0, tableId, 0xB0 | (length >> 8), length & 0xFF, 0, 1, 0xC1, 0, 0]) + body + b"\x00" * 4
+
+
+def BuildSegment(height, audioOnly, size):
+    """生成约 size 字节的 TS 分片：PAT、PMT、带 SPS 的视频 PES，其余用空包填充"""
+    out = bytearray(TsPacket(0, PsiSection(0, bytes([0, 1, 0xE1, 0x00])), True))
+    streams = [(0x0F, 0x102)] if audioOnly else [(0x1B, 0x101), (0x0F, 0x102)]
+    pmt = bytes([0xE1, 0x00, 0xF0, 0x00])
+    for streamType, pid in streams:
+        pmt += bytes([streamType, 0xE0 | (pid >> 8), pid & 0xFF, 0xF0, 0])
+    out += TsPacket(0x100, PsiSection(2, pmt), True)
+    if not audioOnly:
+        width = height * 16 // 9 // 16 * 16
+        es = b"\x00\x00\x00\x01" + H264Sps(width, height) + b"\x00\x00\x01\x65" + b"\x88" * 2000
+        pes = b"\x00\x00\x01\xe0\x00\x00\x80\x80\x05\x21\x00\x01\x00\x01" + es
+        first = True
+        while pes:
+            out += TsPacket(0x101, pes[:184], first)
+            pes = pes[184:]
+            first = False
+    null = TsPacket(0x1FFF, b"\xff" * 184, False)
+    while len(out) < size:
+        out += null
+    return bytes(out)
+
+
+def ParseRange(text, cast=float):
+    """解析 "最小,最大" 或单个值"""
+    parts = [cast(x) for x in text.split(",")]
+    return (parts[0], parts[-1])
+
+
+def ParseWeights(text):
+    """解析 "1080:0.5,720:0.4,576:0.1"""
+    pairs = [x.split(":") for x in text.split(",")]
+    return [int(k) for k, _ in pairs], [float(v) for _, v in pairs]
+
+
+class MockHls:
+    """模拟 HLS 服务，流画像由 seed 和流序号决定，同样的参数每次结果一致"""
+
+    def __init__(self, args):
+        self.args = args
+        self.streams = args.streams
+        self.upstreams = args.upstreams
+        self.segments = {}  # (height, audioOnly) -> 分片字节
+        self.requests = {"upstream": 0, "master": 0, "media": 0, "segment": 0, "error": 0}
+        self.bytesSent = 0
+        self.started = time.time()
+        self.hostFree = {}  # 端口 -> 共享链路空闲的时刻（--host-kbps）
+        self.rng = random.Random(args.seed)
+        self.profiles = [self.BuildProfile(i) for i in range(self.streams)]
+
+    def BuildProfile(self, i):
+        args = self.args
+        rng = random.Random(args.seed * 1000003 + i)
+        heights, weights = ParseWeights(args.res)
+        latMin, latMax = ParseRange(args.latency_ms)
+        bwMin, bwMax = ParseRange(args.bandwidth_kbps)
+        return {
+            "latency": rng.uniform(latMin, latMax) / 1000,
+            "bandwidth": rng.uniform(bwMin, bwMax) * 1000 / 8,  # 字节/秒，0 为不限
+            "dead": rng.random() < args.error_rate,
+            "stale": rng.random() < args.stale_rate,
+            "audioOnly": rng.random() < args.audio_rate,
+            "master": rng.random() < args.master_rate,
+            "height": rng.choices(heights, weights)[0],
+        }
+
+    def Segment(self, profile, height=None):
+        key = (height or profile["height"], profile["audioOnly"])
+        if key not in self.segments:
+            self.segments[key] = BuildSegment(key[0], key[1], self.args.seg_kb * 1024)
+        return self.segments[key]
+
+    def Flaky(self):
+        return self.rng.random() < self.args.flaky_rate
+
+    async def Upstream(self, request):
+        self.requests["upstream"] += 1
+        k = int(request.match_info["k"])
+        host = request.host.rsplit(":", 1)[0]
+        lines = ["#EXTM3U"]
+        for i in range(k, self.streams, self.upstreams):
+            name = NameStyles[i % len(NameStyles)].format(ChannelNames[i % len(ChannelNames)])
+            entry = "master" if self.profiles[i]["master"] else "index"
+            port = self.args.port + i % self.args.hosts
+            lines.append(f'#EXTINF:-1 tvg-name="{name}" group-title="央视",{name}')
+            lines.append(f"http://{host}:{port}/s/{i}/{entry}.m3u8")
+        return web.Response(text="\n".join(lines) + "\n", headers={"ETag": f'"{self.args.seed}-{k}"'})
+
+    async def Stream(self, request, kind):
+        """公共处理：计数、失效/偶发错误、延迟，返回画像或错误响应"""
+        self.requests[kind] += 1
+        if request.url.port and request.url.port >= self.args.port + self.args.hosts - self.args.dead_hosts:
+            # 宕机主机：挂起直到客户端超时断开
+            self.requests["error"] += 1
+            await asyncio.sleep(3600)
+        i = int(request.match_info["id"])
+        if i >= self.streams:
+            return None, web.Response(status=404)
+        profile = self.profiles[i]
+        await asyncio.sleep(profile["latency"])
+        if profile["dead"] or self.Flaky():
+            self.requests["error"] += 1
+            return None, web.Response(status=503 if profile["dead"] else 500)
+        return profile, None
+
+    async def Master(self, request):
+        profile, error = await self.Stream(request, "master")
+        if error:
+            return error
+        h = profile["height"]
+        if self.args.ladder:
+            # 不高于画像分辨率的各档变体，低分辨率在前
+            lines = ["#EXTM3U"]
+            heights, _ = ParseWeights(self.args.res)
+            for vh in sorted(x for x in heights if x <= h):
+                lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={LadderBandwidth.get(vh, vh * 5000)},'
+                             f'RESOLUTION={vh * 16 // 9}x{vh},CODECS="avc1.64001f,mp4a.40.2"')
+                lines.append(f"{vh}p/index.m3u8")
+            return web.Response(text="\n".join(lines) + "\n")
+        w = h * 16 // 9
+        body = (f"#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH={int(profile['bandwidth'] * 8) or 8000000},"
+                f"RESOLUTION={w}x{h}\nindex.m3u8\n")
+        return web.Response(text=body)
+
+    async def Media(self, request):
+        profile, error = await self.Stream(request, "media")
+        if error:
+            return error
+        duration = self.args.target
+        # 停更的流序号固定在启动时刻
+        seq = int((self.started if profile["stale"] else time.time()) // duration)
+        lines = ["#EXTM3U", f"#EXT-X-TARGETDURATION:{duration}", f"#EXT-X-MEDIA-SEQUENCE:{seq}"]
+        for k in range(self.args.window):
+            lines.append(f"#EXTINF:{duration:.1f},")
+            lines.append(f"{seq + k}.ts")
+        return web.Response(text="\n".join(lines) + "\n")
+
+    async def Ts(self, request):
+        profile, error = await self.Stream(request, "segment")
+        if error:
+            return error
+        height = request.match_info.get("h")
+        data = self.Segment(profile, int(height) if height else None)
+        # Range 请求只返回开头
+        status = 200
+        rangeHeader = request.headers.get("Range", "")
+        if rangeHeader.startswith("bytes=0-"):
+            end = int(rangeHeader[8:] or len(data) - 1)
+            data = data[:end + 1]
+            status = 206
+        resp = web.StreamResponse(status=status, headers={"Content-Type": "video/mp2t"})
+        resp.content_length = len(data)
+        bandwidth = profile["bandwidth"]
+        hostRate = self.args.host_kbps * 1000 / 8
+        port = request.url.port
+        chunk = 16384
+        start = time.time()
+        try:
+            await resp.prepare(request)
+            for offset in range(0, len(data), chunk):
+                await resp.write(data[offset:offset + chunk])
+                size = min(chunk, len(data) - offset)
+                self.bytesSent += size
+                now = time.time()
+                ahead = (offset + chunk) / bandwidth - (now - start) if bandwidth else 0
+                if hostRate:
+                    # 共享链路：每个块按到达顺序占用源站带宽，并发下载平分链路
+                    self.hostFree[port] = max(now, self.hostFree.get(port, 0)) + size / hostRate
+                    ahead = max(ahead, self.hostFree[port] - now)
+                if ahead > 0:
+                    await asyncio.sleep(ahead)
+            await resp.write_eof()
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        return resp
+
+    async def Stats(self, request):
+        return web.json_response({"requests": self.requests, "total": sum(self.requests.values()) - self.requests["error"],
+                                  "bytes": self.bytesSent})
+
+    def App(self):
+        app = web.Application()
+        app.router.add_get("/upstream/{k}.m3u", self.Upstream)
+        app.router.add_get("/s/{id}/master.m3u8", self.Master)
+        app.router.add_get("/s/{id}/index.m3u8", self.Media)
+        app.router.add_get("/s/{id}/{seq}.ts", self.Ts)
+        app.router.add_get("/s/{id}/{h:\\d+}p/index.m3u8", self.Media)
+        app.router.add_get("/s/{id}/{h:\\d+}p/{seq}.ts", self.Ts)
+        app.router.add_get("/stats", self.Stats)
+        return app
+
+
+def AddArguments(parser):
+    """模拟服务器参数，基准测试运行器复用"""
+    parser.add_argument("--streams", type=int, default=1000, help="候选流数量")
+    parser.add_argument("--hosts", type=int, default=50, help="模拟的源站数量（连续端口）")
+    parser.add_argument("--upstreams", type=int, default=10, help="上游列表数量")
+    parser.add_argument("--seed", type=int, default=1, help="画像随机种子")
+    parser.add_argument("--latency-ms", default="20,300", help="每条流的响应延迟范围（毫秒）")
+    parser.add_argument("--bandwidth-kbps", default="4000,40000", help="每条流的带宽范围（kbps），0 为不限速")
+    parser.add_argument("--error-rate", type=float, default=0.2, help="失效流比例（所有请求 503）")
+    parser.add_argument("--stale-rate", type=float, default=0.05, help="播放列表停更（序号不前进）的流比例")
+    parser.add_argument("--flaky-rate", type=float, default=0.01, help="正常流每个请求偶发 500 的概率")
+    parser.add_argument("--audio-rate", type=float, default=0.02, help="纯音频流比例")
+    parser.add_argument("--master-rate", type=float, default=0.3, help="以 Master Playlist 提供的流比例")
+    parser.add_argument("--host-kbps", type=int, default=0, help="每个源站所有下载共享的带宽上限（kbps），0 为不限")
+    parser.add_argument("--dead-hosts", type=int, default=0, help="从不响应流请求的源站数量（最后几个端口）")
+    parser.add_argument("--ladder", action="store_true", help="Master Playlist 列出多档分辨率变体（低分辨率在前）")
+    parser.add_argument("--res", default="1080:0.5,720:0.4,576:0.1", help="分辨率分布 高度:权重")
+    parser.add_argument("--seg-kb", type=int, default=128, help="分片大小（KB）")
+    parser.add_argument("--target", type=int, default=2, help="分片时长（秒）")
+    parser.add_argument("--window", type=int, default=6, help="播放列表中的分片数")
+
+
+async def Serve(args):
+    runner = web.AppRunner(MockHls(args).App(), access_log=None)
+    await runner.setup()
+    for k in range(args.hosts):
+        await web.TCPSite(runner, args.host, args.port + k, backlog=4096).start()
+    await asyncio.Event().wait()
+
+
+def Main():
+    parser = argparse.ArgumentParser(description="模拟 HLS 服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18765, help="起始端口，上游列表在第一个端口")
+    AddArguments(parser)
+    args = parser.parse_args()
+    try:
+        asyncio.run(Serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    Main()
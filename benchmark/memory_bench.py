@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+候选存储内存基准测试
+构造 N 条上游条目（分布在多个上游、部分 URL 在多个上游重复出现），分别用旧的对象表示
+（每条一个 dict → {chId: [(url, src)]} → urlMap → 每个 URL 一个结果 dict）和 CandidateStore
+（逐个上游写入 (url, chId) 条目 → 插入时去重 → 并行 array 结果列）构建候选池并写入测速结果，
+每种表示在独立子进程中运行，报告峰值内存（ru_maxrss）和耗时
+
+用法: python benchmark/memory_bench.py [--entries 1000000] [--sources 50] [--channels 1000] [--dup 0.3]
+"""
+
+import argparse
+import json
+import random
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main
+
+
+def PeakRssMB():
+    """进程峰值内存（macOS 单位为字节，Linux 为 KB）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def GenerateSources(args):
+    """按上游逐个生成 (来源名, [(频道名, url, chId), ...])，每条 URL 都是新建的字符串（与解析结果一致）"""
+    rng = random.Random(42)
+    unique = max(1, int(args.entries * (1 - args.dup)))
+    perSource = args.entries // args.sources
+    for k in range(args.sources):
+        items = []
+        for _ in range(perSource):
+            n = rng.randrange(unique)
+            ch = n % args.channels
+            url = f"http://edge{n % 5000}.iptv-{n % 97}.example.com:{8000 + n % 100}/live/{n}/index.m3u8?token={n * 7919 % 1000003}"
+            items.append((f"频道{ch} 高清", url, f"CH-{ch}"))
+        yield f"上游{k}", items
+
+
+def Result(rng):
+    """模拟约 70% 通过的测速结果"""
+    if rng.random() < 0.3:
+        return None
+    return {"ttfb": rng.random(), "speed": rng.random() * 5e6, "speedStd": rng.random() * 1e5}
+
+
+def BuildLegacy(args):
+    """旧表示：上游条目 dict 列表 → 频道分组元组 → urlMap → results"""
+    allItems = []
+    for name, entries in GenerateSources(args):
+        items = [{"name": chName, "url": url, "chId": chId} for chName, url, chId in entries]
+        for item in items:
+            item["source"] = name
+        allItems.extend(items)
+    chDict = {f"CH-{ch}": [] for ch in range(args.channels)}
+    for item in allItems:
+        chDict[item["chId"]].append((item["url"], item["source"]))
+    del allItems
+
+    urlMap = {}
+    for chId, urlList in chDict.items():
+        for url, src in urlList:
+            if url not in urlMap:
+                urlMap[url] = []
+            urlMap[url].append((chId, src))
+    rng = random.Random(1)
+    results = {}
+    for url in urlMap:
+        r = Result(rng)
+        results[url] = dict(r) if r else None
+    return len(urlMap), (chDict, urlMap, results)
+
+
+def BuildStore(args):
+    """CandidateStore：每个上游的 (url, chId) 条目写入后即释放 → 插入时去重 → 并行 array 结果列"""
+    store = main.CandidateStore()
+    for name, entries in GenerateSources(args):
+        main.AddSourceItems(store, name, [(url, chId) for _, url, chId in entries])
+    store.InitScores()
+    rng = random.Random(1)
+    for i in range(len(store)):
+        store.SetTest(i, Result(rng))
+    return len(store), store
+
+
+def RunMode(args):
+    """子进程：构建一种表示，输出 JSON 结果"""
+    main.Channels = {f"CH-{ch}": {} for ch in range(args.channels)}
+    main.Log = lambda msg: None
+    baseline = PeakRssMB()
+    start = time.time()
+    urls, keep = (BuildStore if args.mode == "store" else BuildLegacy)(args)
+    print(json.dumps({"mode": args.mode, "urls": urls, "seconds": round(time.time() - start, 2),
+                      "peakRssMB": round(PeakRssMB(), 1), "growthMB": round(PeakRssMB() - baseline, 1)}))
+
+
+def Main():
+    parser = argparse.ArgumentParser(description="候选存储内存基准测试")
+    parser.add_argument("--entries", type=int, default=1000000, help="上游条目总数")
+    parser.add_argument("--sources", type=int, default=50, help="上游源数量")
+    parser.add_argument("--channels", type=int, default=1000, help="频道数量")
+    parser.add_argument("--dup", type=float, default=0.3, help="重复 URL 比例")
+    parser.add_argument("--mode", choices=["legacy", "store"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        RunMode(args)
+        return
+
+    print(f"{args.entries} 条目，{args.sources} 个上游，{args.channels} 个频道，重复比例 {args.dup}")
+    reports = {}
+    for mode in ("legacy", "store"):
+        cmd = [sys.executable, __file__, "--mode", mode, "--entries", str(args.entries), "--sources", str(args.sources),
+               "--channels", str(args.channels), "--dup", str(args.dup)]
+        report = reports[mode] = json.loads(subprocess.run(cmd, capture_output=True, text=True, check=True).stdout)
+        label = "旧表示" if mode == "legacy" else "CandidateStore"
+        print(f"  {label}: {report['urls']} 个唯一 URL，{report['seconds']}s，"
+              f"峰值内存 {report['peakRssMB']} MB (+{report['growthMB']})")
+    legacy, store = reports["legacy"]["growthMB"], reports["store"]["growthMB"]
+    if legacy > 0:
+        print(f"  内存增长减少 {(1 - store / legacy) * 100:.0f}%")
+
+
+if __name__ == "__main__":
+    Main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+完整流程基准测试
+在子进程中启动模拟 HLS 服务器（hls_mock.py），用指向它的配置执行 RunOnce（不生成 iptv.m3u、不提交），
+报告耗时、请求数、峰值内存和事件循环延迟。可依次测试多个规模，用于建立基线和发现性能回退。
+
+用法:
+    python benchmark/pipeline_bench.py --streams 1000,5000,20000
+    python benchmark/pipeline_bench.py --streams 50000 --seg-kb 64 --set 最大并发数=2000 --json result.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+BenchDir = Path(__file__).resolve().parent
+sys.path.insert(0, str(BenchDir.parent))
+sys.path.insert(0, str(BenchDir))
+import main
+from hls_mock import AddArguments
+
+
+def PeakRssMB():
+    """进程峰值内存（macOS 单位为字节，Linux 为 KB）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def FetchStats(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=5) as resp:
+        return json.load(resp)
+
+
+def StartMock(args, streams):
+    """启动模拟服务器子进程并等待就绪"""
+    cmd = [sys.executable, str(BenchDir / "hls_mock.py"), "--port", str(args.port), "--streams", str(streams)]
+    for key in ("hosts", "upstreams", "seed", "latency_ms", "bandwidth_kbps", "error_rate", "stale_rate", "flaky_rate",
+                "audio_rate", "master_rate", "res", "seg_kb", "target", "window", "dead_hosts", "host_kbps"):
+        cmd += ["--" + key.replace("_", "-"), str(getattr(args, key))]
+    if args.ladder:
+        cmd.append("--ladder")
+    proc = subprocess.Popen(cmd)
+    for _ in range(100):
+        try:
+            FetchStats(args.port)
+            return proc
+        except Exception:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("模拟服务器启动失败")
+
+
+def BuildConfig(args):
+    """复制 config.json 的频道表，上游指向模拟服务器，关闭历史库和上游缓存保证每轮结果可比"""
+    cfg = json.loads((BenchDir.parent / "config.json").read_text(encoding="utf-8"))
+    cfg["上游源"] = [f"http://127.0.0.1:{args.port}/upstream/{k}.m3u" for k in range(args.upstreams)]
+    cfg["散装源"] = {}
+    cfg["黑名单"] = []
+    settings = cfg.setdefault("设置", {})
+    settings["启用历史库"] = args.history
+    settings["启用上游缓存"] = False
+    settings["运行报告文件"] = str(Path(tempfile.gettempdir()) / "LiteIPTV-bench-report.json")
+    settings["Prometheus文件"] = ""
+    for item in args.set:
+        key, value = item.split("=", 1)
+        settings[key] = json.loads(value)
+    return cfg
+
+
+async def MonitorLag(samples, interval=0.05):
+    """每 interval 秒唤醒一次，记录实际唤醒的延迟（秒）"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+
+async def RunBench(cfg, quiet):
+    lagSamples = []
+    monitor = asyncio.ensure_future(MonitorLag(lagSamples))
+    start = time.time()
+    sink = io.StringIO() if quiet else None
+    with contextlib.redirect_stdout(sink) if quiet else contextlib.nullcontext():
+        best = await main.RunOnce(cfg, publish=False)
+    wall = time.time() - start
+    monitor.cancel()
+    return best, wall, lagSamples
+
+
+def Percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def Main():
+    parser = argparse.ArgumentParser(description="完整流程基准测试", conflict_handler="resolve")
+    AddArguments(parser)
+    parser.add_argument("--streams", default="1000", help="候选流数量，逗号分隔可测试多个规模")
+    parser.add_argument("--port", type=int, default=18765)
+    parser.add_argument("--history", action="store_true", help="启用历史库（默认关闭）")
+    parser.add_argument("--set", action="append", default=[], metavar="键=值", help="覆盖 设置 中的参数，值按 JSON 解析")
+    parser.add_argument("--verbose", action="store_true", help="输出 RunOnce 日志")
+    parser.add_argument("--json", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    # 日志写到临时文件，不影响正式日志
+    main.LogFile = Path(tempfile.gettempdir()) / "LiteIPTV-bench.log"
+    main.LogFile.write_text("")
+
+    reports = []
+    for streams in [int(x) for x in args.streams.split(",")]:
+        proc = StartMock(args, streams)
+        try:
+            cfg = BuildConfig(args)
+            rssBefore = PeakRssMB()
+            best, wall, lags = asyncio.run(RunBench(cfg, not args.verbose))
+            stats = FetchStats(args.port)
+        finally:
+            proc.terminate()
+            proc.wait()
+
+        report = {
+            "streams": streams,
+            "channels": len(best),
+            "wall": round(wall, 2),
+            "requests": stats["total"],
+            "requestsByKind": stats["requests"],
+            "bytesMB": round(stats["bytes"] / 1024 / 1024, 1),
+            "peakRssMB": round(PeakRssMB(), 1),
+            "rssGrowthMB": round(PeakRssMB() - rssBefore, 1),
+            "lagMaxMs": round(max(lags, default=0) * 1000, 1),
+            "lagP99Ms": round(Percentile(lags, 0.99) * 1000, 1),
+            "lagMeanMs": round(sum(lags) / len(lags) * 1000, 1) if lags else 0,
+            "stages": main.Metrics.Report()["stages"],
+        }
+        reports.append(report)
+        kinds = ", ".join(f"{k} {v}" for k, v in stats["requests"].items())
+        print(f"{streams} 个候选: {report['wall']}s，选出 {report['channels']} 个频道，"
+              f"请求 {report['requests']} ({kinds})，下载 {report['bytesMB']} MB，"
+              f"峰值内存 {report['peakRssMB']} MB (+{report['rssGrowthMB']})，"
+              f"事件循环延迟 最大 {report['lagMaxMs']} ms / P99 {report['lagP99Ms']} ms / 平均 {report['lagMeanMs']} ms",
+              flush=True)
+        print("  阶段: " + ", ".join(f"{k} {v['wall']}s/{v['calls']}次/峰值 {v['peakInflight']}" for k, v in report["stages"].items()))
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(reports, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+
+
+if __name__ == "__main__":
+    Main()
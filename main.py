@@ -5,19 +5,31 @@ LiteIPTV - 精简稳定的 CCTV 直播源
 每小时运行，多轮测速取最优，仅在源变化时更新
 """
 
+import argparse
 import asyncio
+import contextlib
+import contextvars
+import hashlib
+import heapq
+import ipaddress
 import json
-import os
+import math
 import random
 import re
+import socket
+import sqlite3
 import subprocess
-import tempfile
 import time
+import unicodedata
+from array import array
+from collections import OrderedDict, deque
 from datetime import datetime
 from pathlib import Path
-from urllib.parse import urlparse, urljoin
+from urllib.parse import quote, urlparse, urljoin
 
 import aiohttp
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
 
 # 项目根目录
 RootDir = Path(__file__).parent
@@ -38,49 +50,11 @@ def Log(msg):
         f.write(msg + "\n")
 
 
-# CCTV 频道配置
-Channels = {
-    "CCTV-1": {"name": "CCTV-1 综合", "tvg_name": "CCTV1", "logo": "https://live.fanmingming.cn/tv/CCTV1.png"},
-    "CCTV-2": {"name": "CCTV-2 财经", "tvg_name": "CCTV2", "logo": "https://live.fanmingming.cn/tv/CCTV2.png"},
-    "CCTV-3": {"name": "CCTV-3 综艺", "tvg_name": "CCTV3", "logo": "https://live.fanmingming.cn/tv/CCTV3.png"},
-    "CCTV-4": {"name": "CCTV-4 中文国际", "tvg_name": "CCTV4", "logo": "https://live.fanmingming.cn/tv/CCTV4.png"},
-    "CCTV-5": {"name": "CCTV-5 体育", "tvg_name": "CCTV5", "logo": "https://live.fanmingming.cn/tv/CCTV5.png"},
-    "CCTV-5+": {"name": "CCTV-5+ 体育赛事", "tvg_name": "CCTV5+", "logo": "https://live.fanmingming.cn/tv/CCTV5+.png"},
-    "CCTV-6": {"name": "CCTV-6 电影", "tvg_name": "CCTV6", "logo": "https://live.fanmingming.cn/tv/CCTV6.png"},
-    "CCTV-7": {"name": "CCTV-7 国防军事", "tvg_name": "CCTV7", "logo": "https://live.fanmingming.cn/tv/CCTV7.png"},
-    "CCTV-8": {"name": "CCTV-8 电视剧", "tvg_name": "CCTV8", "logo": "https://live.fanmingming.cn/tv/CCTV8.png"},
-    "CCTV-9": {"name": "CCTV-9 纪录", "tvg_name": "CCTV9", "logo": "https://live.fanmingming.cn/tv/CCTV9.png"},
-    "CCTV-10": {"name": "CCTV-10 科教", "tvg_name": "CCTV10", "logo": "https://live.fanmingming.cn/tv/CCTV10.png"},
-    "CCTV-11": {"name": "CCTV-11 戏曲", "tvg_name": "CCTV11", "logo": "https://live.fanmingming.cn/tv/CCTV11.png"},
-    "CCTV-12": {"name": "CCTV-12 社会与法", "tvg_name": "CCTV12", "logo": "https://live.fanmingming.cn/tv/CCTV12.png"},
-    "CCTV-13": {"name": "CCTV-13 新闻", "tvg_name": "CCTV13", "logo": "https://live.fanmingming.cn/tv/CCTV13.png"},
-    "CCTV-14": {"name": "CCTV-14 少儿", "tvg_name": "CCTV14", "logo": "https://live.fanmingming.cn/tv/CCTV14.png"},
-    "CCTV-15": {"name": "CCTV-15 音乐", "tvg_name": "CCTV15", "logo": "https://live.fanmingming.cn/tv/CCTV15.png"},
-    "CCTV-16": {"name": "CCTV-16 奥林匹克", "tvg_name": "CCTV16", "logo": "https://live.fanmingming.cn/tv/CCTV16.png"},
-    "CCTV-17": {"name": "CCTV-17 农业农村", "tvg_name": "CCTV17", "logo": "https://live.fanmingming.cn/tv/CCTV17.png"},
-}
-
-# 频道匹配正则
-ChannelPatterns = [
-    (r"CCTV[-\s]?1(?:[^\d+]|$)", "CCTV-1"),
-    (r"CCTV[-\s]?2(?:[^\d]|$)", "CCTV-2"),
-    (r"CCTV[-\s]?3(?:[^\d]|$)", "CCTV-3"),
-    (r"CCTV[-\s]?4(?:[^\d]|$)", "CCTV-4"),
-    (r"CCTV[-\s]?5\+|CCTV[-\s]?5加|CCTV5\+", "CCTV-5+"),
-    (r"CCTV[-\s]?5(?:[^\d+]|$)", "CCTV-5"),
-    (r"CCTV[-\s]?6(?:[^\d]|$)", "CCTV-6"),
-    (r"CCTV[-\s]?7(?:[^\d]|$)", "CCTV-7"),
-    (r"CCTV[-\s]?8(?:[^\d]|$)", "CCTV-8"),
-    (r"CCTV[-\s]?9(?:[^\d]|$)", "CCTV-9"),
-    (r"CCTV[-\s]?10(?:[^\d]|$)", "CCTV-10"),
-    (r"CCTV[-\s]?11(?:[^\d]|$)", "CCTV-11"),
-    (r"CCTV[-\s]?12(?:[^\d]|$)", "CCTV-12"),
-    (r"CCTV[-\s]?13(?:[^\d]|$)", "CCTV-13"),
-    (r"CCTV[-\s]?14(?:[^\d]|$)", "CCTV-14"),
-    (r"CCTV[-\s]?15(?:[^\d]|$)", "CCTV-15"),
-    (r"CCTV[-\s]?16(?:[^\d]|$)", "CCTV-16"),
-    (r"CCTV[-\s]?17(?:[^\d]|$)", "CCTV-17"),
-]
+# 频道表 {chId: {name, tvg_name, logo, group}}，由 config.json 的 "频道" 加载
+Channels = {}
+
+# 频道名匹配器，LoadChannels 时编译
+Matcher = None
 
 
 def LoadConfig():
@@ -93,6 +67,29 @@ def LoadConfig():
         return json.load(f)
 
 
+def LoadChannels(cfg):
+    """从配置加载频道表并编译匹配器，返回是否成功"""
+    global Matcher
+    table = cfg.get("频道", {})
+    if not table:
+        Log("错误: config.json 未配置频道")
+        return False
+
+    Channels.clear()
+    aliases = {}
+    for chId, info in table.items():
+        Channels[chId] = {
+            "name": info.get("名称", chId),
+            "tvg_name": info.get("EPG名称", chId),
+            "logo": info.get("台标", ""),
+            "group": info.get("分组", ""),
+        }
+        # 频道 ID 和 EPG 名称默认作为别名
+        aliases[chId] = [chId, Channels[chId]["tvg_name"]] + info.get("别名", [])
+    Matcher = ChannelMatcher(aliases)
+    return True
+
+
 def SaveConfig(cfg):
     """保存配置文件，内容相同则跳过"""
     path = RootDir / "config.json"
@@ -120,73 +117,1204 @@ def GetSourceName(url):
     return url[:30]
 
 
-async def FetchSource(url, maxRetry, retryDelay):
-    """抓取单个上游源，失败时重试，返回 (url, items, success)"""
+# ==================== HTTP 客户端 ====================
+
+class RunMetrics:
+    """运行指标：各阶段耗时与并发、按阶段和类型的请求结果、TTFB/速度直方图、在途任务时间线
+    阶段用 Track 标记，当前阶段保存在 ContextVar 中，HttpClient 据此把请求结果记到对应阶段；
+    结束后 WriteReport 输出 JSON 运行报告，可选 Prometheus 文本格式（供 node_exporter textfile 采集）
+    """
+
+    Buckets = {
+        "ttfb": [0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10],  # 秒
+        "speed": [64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 5e6, 10e6],  # 字节/秒
+        "dns": [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2],  # 秒
+    }
+
+    stage = contextvars.ContextVar("stage", default="other")
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages = {}  # {name: {calls, seconds, max, active, peak, first, last}}
+        self.requests = {}  # {(stage, outcome): count}
+        self.histograms = {name: [0] * (len(b) + 1) + [0.0] for name, b in self.Buckets.items()}  # 各桶计数 + 总和
+        self.timeline = []  # [(相对秒, {stage: 在途数})]
+        self.values = {}  # 其他结果数值（频道数、通过数等）
+
+    @contextlib.contextmanager
+    def Track(self, name):
+        """标记一段阶段调用：计时、统计在途数，期间发起的请求归入该阶段"""
+        st = self.stages.get(name)
+        if st is None:
+            st = self.stages[name] = {"calls": 0, "seconds": 0.0, "max": 0.0, "active": 0, "peak": 0,
+                                      "first": time.time(), "last": 0.0}
+        st["calls"] += 1
+        st["active"] += 1
+        st["peak"] = max(st["peak"], st["active"])
+        token = self.stage.set(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            st["seconds"] += elapsed
+            st["max"] = max(st["max"], elapsed)
+            st["last"] = time.time()
+            st["active"] -= 1
+            self.stage.reset(token)
+
+    def Request(self, outcome):
+        """记录一次 HTTP 请求结果：ok / http_4xx / http_5xx / timeout / error"""
+        key = (self.stage.get(), outcome)
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+    def Observe(self, name, value):
+        buckets = self.Buckets[name]
+        counts = self.histograms[name]
+        i = 0
+        while i < len(buckets) and value > buckets[i]:
+            i += 1
+        counts[i] += 1
+        counts[-1] += value
+
+    def Set(self, name, value):
+        self.values[name] = value
+
+    async def Sample(self, interval=1.0):
+        """后台采样各阶段在途数"""
+        while True:
+            active = {name: st["active"] for name, st in self.stages.items() if st["active"]}
+            self.timeline.append((round(time.time() - self.start, 1), active))
+            await asyncio.sleep(interval)
+
+    def Report(self):
+        stages = {}
+        for name, st in self.stages.items():
+            stages[name] = {
+                "calls": st["calls"],
+                "wall": round(max(st["last"] - st["first"], 0), 2),  # 第一次开始到最后一次结束
+                "seconds": round(st["seconds"], 2),  # 各次调用累加
+                "mean": round(st["seconds"] / st["calls"], 3) if st["calls"] else 0,
+                "max": round(st["max"], 2),
+                "peakInflight": st["peak"],
+            }
+        requests = {}
+        for (stage, outcome), count in sorted(self.requests.items()):
+            requests.setdefault(stage, {})[outcome] = count
+        histograms = {}
+        for name, buckets in self.Buckets.items():
+            counts = self.histograms[name]
+            labels = [f"{b:.15g}" for b in buckets] + ["+Inf"]
+            histograms[name] = {"buckets": dict(zip(labels, counts[:-1])), "count": sum(counts[:-1]), "sum": round(counts[-1], 3)}
+        return {
+            "start": datetime.fromtimestamp(self.start).strftime("%Y-%m-%d %H:%M:%S"),
+            "duration": round(time.time() - self.start, 2),
+            "stages": stages,
+            "requests": requests,
+            "histograms": histograms,
+            "inflight": [{"t": t, **active} for t, active in self.timeline],
+            **self.values,
+        }
+
+    def Prometheus(self, report):
+        lines = [f"liteiptv_run_duration_seconds {report['duration']}",
+                 f"liteiptv_run_timestamp_seconds {int(self.start)}"]
+        lines.append("# TYPE liteiptv_result gauge")
+        for name, value in self.values.items():
+            # bool 也是 int，按 0/1 输出（文本格式不接受 True/False）
+            if isinstance(value, (int, float)):
+                lines.append(f'liteiptv_result{{name="{name}"}} {int(value) if isinstance(value, bool) else value}')
+        for name, st in report["stages"].items():
+            lines.append(f'liteiptv_stage_wall_seconds{{stage="{name}"}} {st["wall"]}')
+            lines.append(f'liteiptv_stage_seconds_total{{stage="{name}"}} {st["seconds"]}')
+            lines.append(f'liteiptv_stage_calls_total{{stage="{name}"}} {st["calls"]}')
+            lines.append(f'liteiptv_stage_inflight_peak{{stage="{name}"}} {st["peakInflight"]}')
+        for stage, outcomes in report["requests"].items():
+            for outcome, count in outcomes.items():
+                lines.append(f'liteiptv_http_requests_total{{stage="{stage}",outcome="{outcome}"}} {count}')
+        for name, buckets in self.Buckets.items():
+            unit = "bytes_per_second" if name == "speed" else "seconds"
+            counts = self.histograms[name]
+            total = 0
+            lines.append(f"# TYPE liteiptv_{name}_{unit} histogram")
+            for le, count in zip([f"{b:.15g}" for b in buckets] + ["+Inf"], counts[:-1]):
+                total += count
+                lines.append(f'liteiptv_{name}_{unit}_bucket{{le="{le}"}} {total}')
+            lines.append(f"liteiptv_{name}_{unit}_sum {counts[-1]:.3f}")
+            lines.append(f"liteiptv_{name}_{unit}_count {total}")
+        return "\n".join(lines) + "\n"
+
+    def WriteReport(self, jsonFile, promFile=None):
+        """写入 JSON 运行报告和可选的 Prometheus 文本文件（先写临时文件再替换，采集时不会读到半个文件）"""
+        report = self.Report()
+        for filename, content in ((jsonFile, lambda: json.dumps(report, ensure_ascii=False, indent=2) + "\n"),
+                                  (promFile, lambda: self.Prometheus(report))):
+            if not filename:
+                continue
+            path = RootDir / filename
+            tmp = path.with_name(path.name + ".tmp")
+            tmp.write_text(content(), encoding="utf-8")
+            tmp.replace(path)
+        return report
+
+
+# 当前运行的指标，RunOnce 开始时重建
+Metrics = RunMetrics()
+
+
+class HttpClient:
+    """运行级共享 HTTP 客户端：连接池 + keep-alive 复用，所有阶段共用一个实例"""
+
+    def __init__(self, maxConn=1000, perHost=0, keepalive=30, cache=None, hostLimiter=None, resolver=None,
+                 breaker=None):
+        self.maxConn = maxConn
+        self.perHost = perHost
+        self.keepalive = keepalive
+        self.cache = cache
+        self.hostLimiter = hostLimiter
+        self.breaker = breaker
+        self.resolver = resolver or HostResolver()
+        self.variants = {}  # Master 地址 -> (选中的变体地址, 声明高度)，由 TestVariants 写入
+        self.session = None
+        # 连接池槽位：在计时前占用，连接器内部不再排队，TTFB 和超时不含等待空闲连接的时间
+        self.pool = asyncio.Semaphore(maxConn) if maxConn else None
+        # 连接统计
+        self.newConns = 0
+        self.reusedConns = 0
+
+    async def __aenter__(self):
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._OnCreate)
+        trace.on_connection_reuseconn.append(self._OnReuse)
+        trace.on_connection_queued_start.append(self._OnQueued)
+        trace.on_connection_queued_end.append(self._OnDequeued)
+        connector = aiohttp.TCPConnector(
+            limit=self.maxConn,
+            limit_per_host=self.perHost,
+            keepalive_timeout=self.keepalive,
+            resolver=self.resolver,
+            use_dns_cache=False,  # 由 HostResolver 缓存，连接器不再重复缓存
+            family=socket.AF_INET,
+            ssl=False,
+        )
+        self.session = aiohttp.ClientSession(connector=connector, trust_env=False, trace_configs=[trace])
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def _OnCreate(self, session, ctx, params):
+        self.newConns += 1
+
+    async def _OnReuse(self, session, ctx, params):
+        self.reusedConns += 1
+
+    async def _OnQueued(self, session, ctx, params):
+        if ctx.trace_request_ctx is not None:
+            ctx.trace_request_ctx["queuedAt"] = time.time()
+
+    async def _OnDequeued(self, session, ctx, params):
+        # 单主机连接上限等仍可能在连接器内排队，排队时间从 TTFB 中扣除
+        request = ctx.trace_request_ctx
+        if request is not None and "queuedAt" in request:
+            request["queued"] += time.time() - request.pop("queuedAt")
+
+    @contextlib.asynccontextmanager
+    async def Get(self, url, timeout=10, **kwargs):
+        """发起 GET 请求，产出 aiohttp 响应
+        有 hostLimiter 时先占用该主机的并发槽位，请求结果（成功/超时/5xx）反馈给限流器；
+        有 breaker 时主机熔断中直接抛出 HostOpenError，连接失败/超时/收到响应反馈给熔断器；
+        计时从占到连接池槽位之后开始：resp.ttfb 为发出请求（含 DNS、建连）到收到响应头的时间，
+        不含等待主机并发槽位、连接池槽位的时间，也扣除连接器内部（单主机连接上限）的排队时间；
+        超时 timeout 同样不含前两种排队（单主机连接上限的排队仍计入）
+        """
+        host = urlparse(url).netloc
+        breaker = self.breaker
+        allowed = breaker.Allow(host) if breaker else True
+        if not allowed:
+            Metrics.Request("circuit_open")
+            raise HostOpenError(f"{host} 熔断中")
+        trial = allowed == "trial"
+        limiter = self.hostLimiter
+        if limiter:
+            try:
+                await limiter.Acquire(host)
+            except asyncio.CancelledError:
+                if breaker:
+                    breaker.Record(host, None, trial=trial)
+                raise
+            # 排队等待槽位期间主机可能已熔断（宕机主机的并发上限会降到 1，排队的请求最多）
+            if breaker and allowed is True:
+                allowed = breaker.Allow(host)
+                if not allowed:
+                    limiter.Release(host, None)
+                    Metrics.Request("circuit_open")
+                    raise HostOpenError(f"{host} 熔断中")
+                trial = allowed == "trial"
+        if self.pool:
+            try:
+                await self.pool.acquire()
+            except asyncio.CancelledError:
+                if limiter:
+                    limiter.Release(host, None)
+                if breaker:
+                    breaker.Record(host, None, trial=trial)
+                raise
+        outcome = "fail"
+        status = 0
+        reachable = None  # 熔断器反馈：收到响应 / 连接失败或超时
+        traceCtx = {"queued": 0.0}
+        start = time.time()
+        try:
+            async with self.session.get(url, timeout=aiohttp.ClientTimeout(total=timeout),
+                                        trace_request_ctx=traceCtx, **kwargs) as resp:
+                resp.ttfb = time.time() - start - traceCtx["queued"]
+                status = resp.status
+                reachable = True
+                outcome = "error" if resp.status >= 500 else "ok"
+                yield resp
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            if reachable is None:
+                reachable = False
+            raise
+        except asyncio.CancelledError:
+            outcome = None
+            raise
+        except aiohttp.ClientConnectorError:
+            reachable = False
+            raise
+        except Exception:
+            if outcome == "ok":
+                outcome = "fail"
+            raise
+        finally:
+            if self.pool:
+                self.pool.release()
+            if breaker:
+                breaker.Record(host, reachable, time.time() - start, trial)
+            if limiter:
+                limiter.Release(host, outcome)
+            if outcome == "timeout":
+                Metrics.Request("timeout")
+            elif status >= 500:
+                Metrics.Request("http_5xx")
+            elif status >= 400:
+                Metrics.Request("http_4xx")
+            elif outcome == "ok":
+                Metrics.Request("ok")
+            elif outcome:
+                Metrics.Request("error")
+
+    def LogStats(self):
+        """输出连接复用统计"""
+        total = self.newConns + self.reusedConns
+        rate = self.reusedConns / total * 100 if total else 0
+        Log(f"连接统计: 复用 {self.reusedConns} 次, 新建 {self.newConns} 次 (复用率 {rate:.1f}%)")
+        self.resolver.LogStats()
+        if self.cache:
+            self.cache.LogStats()
+        if self.hostLimiter:
+            self.hostLimiter.LogStats()
+        if self.breaker:
+            self.breaker.LogStats()
+
+
+class HostLimiter:
+    """按主机自适应并发（AIMD）
+    每个主机从 initial 个并发开始，请求成功时加性增加（每成功约 limit 次加 1），
+    超时或 5xx 时减半（同一主机 1 秒内只减一次），范围 [1, maxLimit]
+    """
+
+    def __init__(self, initial=8, maxLimit=64):
+        self.initial = initial
+        self.maxLimit = maxLimit
+        self.hosts = {}
+
+    def _State(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = {
+                "limit": float(self.initial), "minLimit": float(self.initial), "active": 0,
+                "waiters": deque(), "lastDecrease": 0.0,
+                "requests": 0, "timeouts": 0, "errors": 0, "fails": 0,
+            }
+        return state
+
+    async def Acquire(self, host):
+        state = self._State(host)
+        if state["active"] < int(state["limit"]) and not state["waiters"]:
+            state["active"] += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        state["waiters"].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 已分到槽位但被取消，归还
+                state["active"] -= 1
+                self._Wake(state)
+            else:
+                state["waiters"].remove(waiter)
+            raise
+
+    def Release(self, host, outcome):
+        """outcome: ok / timeout / error(5xx) / fail(其他错误) / None(取消)"""
+        state = self.hosts[host]
+        state["active"] -= 1
+        if outcome is not None:
+            state["requests"] += 1
+        if outcome == "ok":
+            state["limit"] = min(self.maxLimit, state["limit"] + 1 / state["limit"])
+        elif outcome in ("timeout", "error"):
+            state["timeouts" if outcome == "timeout" else "errors"] += 1
+            now = time.monotonic()
+            if now - state["lastDecrease"] >= 1:
+                state["limit"] = max(1.0, state["limit"] / 2)
+                state["minLimit"] = min(state["minLimit"], state["limit"])
+                state["lastDecrease"] = now
+        elif outcome == "fail":
+            state["fails"] += 1
+        self._Wake(state)
+
+    def _Wake(self, state):
+        while state["waiters"] and state["active"] < int(state["limit"]):
+            waiter = state["waiters"].popleft()
+            if not waiter.done():
+                state["active"] += 1
+                waiter.set_result(None)
+
+    def LogStats(self, top=10):
+        """输出请求最多的主机的并发上限和错误率，以及被限流过的主机数"""
+        hosts = sorted(self.hosts.items(), key=lambda kv: kv[1]["requests"], reverse=True)
+        throttled = sum(1 for _, st in hosts if st["minLimit"] < self.initial)
+        Log(f"主机并发: {len(hosts)} 个主机，{throttled} 个曾被降速")
+        for host, st in hosts[:top]:
+            if not st["requests"]:
+                continue
+            bad = st["timeouts"] + st["errors"] + st["fails"]
+            Log(f"  {host}: 上限 {st['limit']:.1f} (最低 {st['minLimit']:.1f})，请求 {st['requests']}，"
+                f"超时 {st['timeouts']}，5xx {st['errors']}，其他错误 {st['fails']}，错误率 {bad / st['requests'] * 100:.0f}%")
+
+
+class HostOpenError(aiohttp.ClientConnectionError):
+    """主机熔断中，请求未发出直接失败"""
+
+
+class HostBreaker:
+    """按主机熔断：连续 threshold 次连接失败或超时后熔断（open），冷却期内该主机的请求直接失败；
+    冷却结束后放行一个试探请求（half-open），成功则恢复，失败则冷却时间翻倍（带随机抖动，最长 maxCooldown）。
+    收到任何 HTTP 响应（含 4xx/5xx）都说明主机可达，不计为失败。
+    节省时间按该主机失败请求的平均耗时 × 快速失败次数估算。
+    """
+
+    def __init__(self, threshold=5, cooldown=30, maxCooldown=600):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.maxCooldown = maxCooldown
+        self.hosts = {}
+
+    def _State(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = {
+                "fails": 0, "openUntil": 0.0, "cooldown": self.cooldown, "trial": False,
+                "opens": 0, "rejected": 0, "failCount": 0, "failSeconds": 0.0,
+            }
+        return state
+
+    def Allow(self, host):
+        """是否放行请求：True 放行，"trial" 为冷却结束后的试探请求（同时只有一个），False 熔断中"""
+        state = self.hosts.get(host)
+        if state is None or not state["openUntil"]:
+            return True
+        if time.time() >= state["openUntil"] and not state["trial"]:
+            state["trial"] = True
+            return "trial"
+        state["rejected"] += 1
+        return False
+
+    def Record(self, host, reachable, elapsed=0.0, trial=False):
+        """reachable: True 收到响应 / False 连接失败或超时 / None 请求被取消或其他错误"""
+        state = self._State(host)
+        if reachable is None:
+            if trial:
+                state["trial"] = False
+            return
+        if reachable:
+            if state["openUntil"]:
+                Log(f"熔断恢复: {host}")
+            state.update(fails=0, openUntil=0.0, cooldown=self.cooldown, trial=False)
+            return
+        state["fails"] += 1
+        state["failCount"] += 1
+        state["failSeconds"] += elapsed
+        if trial:
+            # 试探失败，冷却翻倍
+            state["cooldown"] = min(self.maxCooldown, state["cooldown"] * 2)
+            self._Open(state)
+        elif not state["openUntil"] and state["fails"] >= self.threshold:
+            state["opens"] += 1
+            self._Open(state)
+            Log(f"熔断: {host} 连续 {state['fails']} 次连接失败或超时，冷却 {state['cooldown']:.0f}s")
+
+    def _Open(self, state):
+        state["trial"] = False
+        state["openUntil"] = time.time() + state["cooldown"] * random.uniform(0.8, 1.2)
+
+    def Saved(self):
+        """估算快速失败节省的请求时间（秒）"""
+        return sum(st["rejected"] * st["failSeconds"] / st["failCount"]
+                   for st in self.hosts.values() if st["failCount"])
+
+    def Load(self, path):
+        """读取上次运行保存的熔断状态（只保留仍在冷却期或已到期待试探的主机）"""
+        try:
+            data = json.loads(Path(path).read_text(encoding="utf-8"))
+        except:
+            return
+        for host, (openUntil, cooldown) in data.items():
+            state = self._State(host)
+            state.update(openUntil=openUntil, cooldown=cooldown, fails=self.threshold)
+        if data:
+            Log(f"熔断状态: 载入 {len(data)} 个熔断主机")
+
+    def Save(self, path):
+        data = {host: [st["openUntil"], st["cooldown"]] for host, st in self.hosts.items() if st["openUntil"]}
+        Path(path).write_text(json.dumps(data, ensure_ascii=False) + "\n", encoding="utf-8")
+
+    def LogStats(self):
+        opened = [host for host, st in self.hosts.items() if st["opens"]]
+        rejected = sum(st["rejected"] for st in self.hosts.values())
+        if not opened and not rejected:
+            return
+        still = sum(1 for st in self.hosts.values() if st["openUntil"])
+        Log(f"主机熔断: {len(opened)} 个主机熔断过，{still} 个仍在熔断，快速失败 {rejected} 次，估计节省请求时间 {self.Saved():.0f}s")
+        Metrics.Set("breakerOpened", len(opened))
+        Metrics.Set("breakerRejected", rejected)
+        Metrics.Set("breakerSavedSeconds", round(self.Saved(), 1))
+
+
+# 熔断状态文件（熔断状态持久化 开启时跨运行保留熔断中的主机）
+BreakerStateFile = RootDir / "breaker-state.json"
+
+
+class RunCache:
+    """运行级 LRU 缓存：播放列表、已解析的变体地址、小分片
+    key 为 (类型, url)；每项带过期时间，总大小超过 maxBytes 时淘汰最久未用的项；
+    同一 key 的并发加载只发一次请求
+    """
+
+    def __init__(self, maxBytes=64 * 1024 * 1024, ttl=30):
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.items = OrderedDict()  # key -> (过期时间, 大小, 值)
+        self.inflight = {}
+        self.size = 0
+        self.saved = {"playlist": 0, "variant": 0, "segment": 0}
+
+    def Get(self, key):
+        entry = self.items.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._Remove(key)
+            return None
+        self.items.move_to_end(key)
+        self.saved[key[0]] += 1
+        return entry[2]
+
+    def Put(self, key, value, size, ttl=None):
+        if size > self.maxBytes:
+            return
+        if key in self.items:
+            self._Remove(key)
+        self.items[key] = (time.monotonic() + (ttl if ttl is not None else self.ttl), size, value)
+        self.size += size
+        while self.size > self.maxBytes:
+            self._Remove(next(iter(self.items)))
+
+    def _Remove(self, key):
+        entry = self.items.pop(key)
+        self.size -= entry[1]
+
+    async def Load(self, key, loader, ttlFunc=None):
+        """命中直接返回；同一 key 正在加载则等待同一结果；否则调用 loader 并缓存非空结果"""
+        value = self.Get(key)
+        if value is not None:
+            return value
+        if key in self.inflight:
+            value = await asyncio.shield(self.inflight[key])
+            if value is not None:
+                self.saved[key[0]] += 1
+            return value
+
+        future = asyncio.ensure_future(loader())
+        self.inflight[key] = future
+        try:
+            value = await asyncio.shield(future)
+        finally:
+            self.inflight.pop(key, None)
+        if value is not None:
+            self.Put(key, value, len(value), ttlFunc(value) if ttlFunc else None)
+        return value
+
+    def PlaylistTtl(self, content):
+        """播放列表有效期：直播列表不超过半个 TARGETDURATION，点播/Master 用默认有效期"""
+        match = re.search(r"#EXT-X-TARGETDURATION:\s*(\d+(?:\.\d+)?)", content)
+        if match and "#EXT-X-ENDLIST" not in content:
+            return min(self.ttl, float(match.group(1)) / 2)
+        return self.ttl
+
+    def LogStats(self):
+        total = sum(self.saved.values())
+        Log(f"运行缓存: 节省 {total} 次请求 (播放列表 {self.saved['playlist']}, "
+            f"变体 {self.saved['variant']}, 分片 {self.saved['segment']})")
+
+
+class HostResolver(AbstractResolver):
+    """运行级 DNS 缓存：只解析 IPv4（AF_INET），结果按 TTL 缓存，同一主机的并发解析只查一次
+    作为 TCPConnector 的 resolver 使用，守护模式下跨轮次复用；解析失败也缓存（最多 60 秒），避免反复查询
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.resolver = aiohttp.ThreadedResolver()
+        self.items = {}  # host -> (过期时间, [ip...])
+        self.inflight = {}
+        self.lookups = 0
+        self.hits = 0
+        self.failures = 0
+
+    async def Lookup(self, host):
+        """返回主机的 IPv4 地址列表，没有 A 记录时返回空列表；IP 字面量直接返回"""
+        try:
+            ip = ipaddress.ip_address(host)
+            return [host] if ip.version == 4 else []
+        except ValueError:
+            pass
+        entry = self.items.get(host)
+        if entry and entry[0] >= time.monotonic():
+            self.hits += 1
+            return entry[1]
+        if host in self.inflight:
+            self.hits += 1
+            return await asyncio.shield(self.inflight[host])
+
+        future = asyncio.ensure_future(self._Resolve(host))
+        self.inflight[host] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            self.inflight.pop(host, None)
+
+    async def _Resolve(self, host):
+        self.lookups += 1
+        start = time.time()
+        with Metrics.Track("dns"):
+            try:
+                infos = await self.resolver.resolve(host, 0, family=socket.AF_INET)
+                addrs = list(dict.fromkeys(info["host"] for info in infos))
+            except OSError:
+                addrs = []
+        Metrics.Observe("dns", time.time() - start)
+        if not addrs:
+            self.failures += 1
+        self.items[host] = (time.monotonic() + (self.ttl if addrs else min(self.ttl, 60)), addrs)
+        return addrs
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        addrs = await self.Lookup(host)
+        if not addrs:
+            raise OSError(f"{host} 没有 IPv4 地址")
+        return [{"hostname": host, "host": ip, "port": port, "family": socket.AF_INET,
+                 "proto": 0, "flags": socket.AI_NUMERICHOST} for ip in addrs]
+
+    async def close(self):
+        await self.resolver.close()
+
+    def LogStats(self):
+        if self.lookups:
+            Log(f"DNS 缓存: 解析 {self.lookups} 次，命中 {self.hits} 次，无 IPv4 地址 {self.failures} 个主机")
+
+
+# ==================== 上游缓存 ====================
+
+CacheDir = RootDir / "Cache"
+
+
+class UpstreamCache:
+    """上游源磁盘缓存
+    upstream/<key>.json 保存 ETag/Last-Modified/内容哈希，upstream/<key>.m3u 保存原文，
+    parsed/<hash>-<筛选签名>.json 保存解析筛选结果（内容和筛选条件不变则不重复解析）
+    """
+
+    def __init__(self, root=CacheDir):
+        self.upstreamDir = root / "upstream"
+        self.parsedDir = root / "parsed"
+        self.upstreamDir.mkdir(parents=True, exist_ok=True)
+        self.parsedDir.mkdir(parents=True, exist_ok=True)
+
+    def _Key(self, url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+
+    def _Meta(self, url):
+        path = self.upstreamDir / f"{self._Key(url)}.json"
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except:
+            return None
+
+    def Headers(self, url):
+        """条件请求头"""
+        meta = self._Meta(url)
+        headers = {}
+        if meta and (self.upstreamDir / f"{self._Key(url)}.m3u").exists():
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("lastModified"):
+                headers["If-Modified-Since"] = meta["lastModified"]
+        return headers
+
+    def Writer(self, url):
+        """边下载边写入原文，返回 UpstreamWriter"""
+        return UpstreamWriter(self, url)
+
+    def _SaveParsed(self, digest, parser):
+        path = self.parsedDir / f"{digest}-{parser.Signature()}.json"
+        data = {"items": parser.items, "stats": parser.stats}
+        path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+
+    def Load(self, url, parser):
+        """读取缓存的解析结果到 parser，无缓存返回 False"""
+        meta = self._Meta(url)
+        body = self.upstreamDir / f"{self._Key(url)}.m3u"
+        if not meta or not body.exists():
+            return False
+        path = self.parsedDir / f"{meta['hash']}-{parser.Signature()}.json"
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            parser.items, parser.stats = data["items"], data["stats"]
+            return True
+        except:
+            pass
+        # 筛选条件变化或解析缓存丢失，从原文重新解析
+        try:
+            with open(body, "rb") as f:
+                for chunk in iter(lambda: f.read(65536), b""):
+                    parser.Feed(chunk)
+            parser.Close()
+            self._SaveParsed(meta["hash"], parser)
+            return True
+        except:
+            return False
+
+    def Prune(self, sources):
+        """删除已不在配置中的上游缓存，以及不再被引用的解析结果"""
+        keep = {self._Key(url) for url in sources}
+        hashes = set()
+        for path in self.upstreamDir.glob("*.json"):
+            if path.stem not in keep:
+                path.unlink(missing_ok=True)
+                (self.upstreamDir / f"{path.stem}.m3u").unlink(missing_ok=True)
+                continue
+            try:
+                hashes.add(json.loads(path.read_text(encoding="utf-8")).get("hash"))
+            except:
+                pass
+        for path in self.parsedDir.glob("*.json"):
+            if path.stem.split("-")[0] not in hashes:
+                path.unlink(missing_ok=True)
+
+
+class UpstreamWriter:
+    """流式写入上游原文到临时文件，同时计算内容哈希，Commit 后替换旧缓存"""
+
+    def __init__(self, cache, url):
+        self.cache = cache
+        self.url = url
+        self.key = cache._Key(url)
+        self.tmpPath = cache.upstreamDir / f"{self.key}.m3u.tmp"
+        self.file = open(self.tmpPath, "wb")
+        self.hasher = hashlib.sha1()
+
+    def Write(self, chunk):
+        self.file.write(chunk)
+        self.hasher.update(chunk)
+
+    def Commit(self, respHeaders, parser):
+        self.file.close()
+        digest = self.hasher.hexdigest()
+        self.tmpPath.replace(self.cache.upstreamDir / f"{self.key}.m3u")
+        meta = {
+            "url": self.url,
+            "etag": respHeaders.get("ETag"),
+            "lastModified": respHeaders.get("Last-Modified"),
+            "hash": digest,
+            "fetched": time.time(),
+        }
+        (self.cache.upstreamDir / f"{self.key}.json").write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+        self.cache._SaveParsed(digest, parser)
+
+    def Abort(self):
+        self.file.close()
+        self.tmpPath.unlink(missing_ok=True)
+
+
+# ==================== m3u 解析 ====================
+
+def ParseExtInf(line):
+    """解析 #EXTINF 行，返回 (属性字典, 频道名)；频道名为第一个引号外逗号之后的内容"""
+    body = line[len("#EXTINF:"):]
+    inQuote = False
+    split = -1
+    for i, c in enumerate(body):
+        if c == '"':
+            inQuote = not inQuote
+        elif c == "," and not inQuote:
+            split = i
+            break
+    if split < 0:
+        return {}, ""
+    attrs = dict(re.findall(r'([\w-]+)="([^"]*)"', body[:split]))
+    return attrs, body[split + 1:].strip()
+
+
+class M3UStreamParser:
+    """增量 m3u 解析器：按块喂入字节，逐行解析，边解析边筛选
+    - 支持 CRLF、BOM、#EXTINF 属性，以及 EXTINF 与 URL 之间的 #EXTVLCOPT/#KODIPROP 等行
+    - filterChannels=True 时只保留能匹配到频道且不在黑名单、非 IPv6 的条目，items 为 (url, chId)，不保留频道名
+    - filterChannels=False 时 items 为 {"name", "url"}
+    """
+
+    def __init__(self, blacklist=None, filterChannels=True):
+        self.blacklist = blacklist or []
+        self.filterChannels = filterChannels
+        self.buffer = b""
+        self.pendingName = None
+        self.pendingAttrs = None
+        self.items = []
+        self.stats = {"total": 0, "unmatched": 0, "blacklisted": 0, "ipv6": 0}
+
+    def Signature(self):
+        """筛选条件签名，用于解析结果缓存"""
+        if not self.filterChannels:
+            return "all"
+        # 2 为条目格式版本，格式变化后旧的解析缓存自动失效
+        key = json.dumps([2, self.blacklist, Matcher.Signature() if Matcher else ""], ensure_ascii=False)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+    def Feed(self, chunk):
+        self.buffer += chunk
+        lines = self.buffer.split(b"\n")
+        self.buffer = lines.pop()
+        for raw in lines:
+            self._Line(raw)
+
+    def Close(self):
+        if self.buffer:
+            self._Line(self.buffer)
+            self.buffer = b""
+        self.pendingName = None
+
+    def _Line(self, raw):
+        line = raw.decode("utf-8", errors="replace").strip().lstrip("\ufeff")
+        if not line:
+            return
+        if line.startswith("#EXTINF:"):
+            self.pendingAttrs, self.pendingName = ParseExtInf(line)
+            return
+        if line.startswith("#"):
+            # #EXTVLCOPT / #KODIPROP / #EXTGRP 等，不打断当前条目
+            return
+        if self.pendingName is None:
+            return
+
+        attrs = self.pendingAttrs
+        name = self.pendingName or attrs.get("tvg-name", "")
+        self.pendingName = None
+        url = line.split("#")[0].strip()
+        if not url:
+            return
+        self.stats["total"] += 1
+
+        if not self.filterChannels:
+            if name:
+                self.items.append({"name": name, "url": url})
+            return
+
+        chId = (MatchChannel(name) if name else None) or MatchChannel(attrs.get("tvg-name", ""))
+        if not chId:
+            self.stats["unmatched"] += 1
+            return
+        if IsBlacklisted(url, self.blacklist):
+            self.stats["blacklisted"] += 1
+            return
+        if IsIPv6Url(url):
+            self.stats["ipv6"] += 1
+            return
+        self.items.append((url, chId))
+
+
+def RetryDelay(base, attempt, cap=60):
+    """第 attempt 次（从 0 开始）失败后的等待时间：指数退避 base × 2^attempt（最长 cap 秒），乘以 0.5~1 的随机抖动，
+    避免多个上游同时失败后同时重试"""
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1)
+
+
+async def FetchSource(client, url, maxRetry, retryDelay, cache=None, blacklist=None):
+    """抓取单个上游源，失败时按指数退避重试，返回 (url, items, stats, success)
+    边下载边解析筛选，只保留匹配频道的条目；提供 cache 时发送条件请求，304 或抓取失败时使用缓存；
+    上游主机熔断中时不再重试
+    """
     name = GetSourceName(url)
+    headers = cache.Headers(url) if cache else {}
 
     for attempt in range(maxRetry):
+        parser = M3UStreamParser(blacklist)
+        writer = None
         try:
-            connector = aiohttp.TCPConnector()
-            async with aiohttp.ClientSession(connector=connector, trust_env=False) as session:
-                async with session.get(url, timeout=aiohttp.ClientTimeout(total=30), ssl=False) as resp:
-                    if resp.status == 200:
-                        content = await resp.text()
-                        if content:
-                            items = ParseM3U(content)
-                            for item in items:
-                                item["source"] = name
-                            Log(f"已抓取 {name}: {len(items)} 个频道")
-                            return url, items, True
+            async with client.Get(url, timeout=30, headers=headers) as resp:
+                if resp.status == 304 and cache:
+                    if cache.Load(url, parser):
+                        Log(f"未变化 {name}: {parser.stats['total']} 个频道，匹配 {len(parser.items)} 个（缓存）")
+                        return url, parser.items, parser.stats, True
+                    # 缓存丢失，去掉条件头重新抓取
+                    headers = {}
+                    continue
+                if resp.status == 200:
+                    writer = cache.Writer(url) if cache else None
+                    size = 0
+                    async for chunk in resp.content.iter_chunked(65536):
+                        size += len(chunk)
+                        parser.Feed(chunk)
+                        if writer:
+                            writer.Write(chunk)
+                    parser.Close()
+                    if size:
+                        if writer:
+                            writer.Commit(resp.headers, parser)
+                        Log(f"已抓取 {name}: {parser.stats['total']} 个频道，匹配 {len(parser.items)} 个")
+                        return url, parser.items, parser.stats, True
+                    if writer:
+                        writer.Abort()
             if attempt < maxRetry - 1:
-                await asyncio.sleep(retryDelay)
-        except:
+                await asyncio.sleep(RetryDelay(retryDelay, attempt))
+        except HostOpenError:
+            # 上游主机熔断中，不再重试，直接使用缓存
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            # 只重试网络错误，取消和中断照常抛出（守护模式退出不被上游抓取卡住）
+            if writer:
+                writer.Abort()
             if attempt < maxRetry - 1:
-                await asyncio.sleep(retryDelay)
+                await asyncio.sleep(RetryDelay(retryDelay, attempt))
+
+    # 抓取失败，使用上次缓存，避免该源的频道本次丢失
+    parser = M3UStreamParser(blacklist)
+    if cache and cache.Load(url, parser) and parser.items:
+        Log(f"抓取失败 {name}: 使用缓存，匹配 {len(parser.items)} 个")
+        return url, parser.items, parser.stats, False
 
     Log(f"抓取失败 {name}: {maxRetry} 次尝试均失败")
-    return url, [], False
+    return url, [], parser.stats, False
 
 
-async def FetchAllSources(sources, maxRetry, retryDelay):
-    """并行抓取所有上游源"""
-    tasks = [FetchSource(url, maxRetry, retryDelay) for url in sources]
-    results = await asyncio.gather(*tasks)
+async def FetchAllSources(client, sources, maxRetry, retryDelay, cache=None, blacklist=None):
+    """并行抓取所有上游源，返回 CandidateStore
+    按配置顺序写入（先完成的上游等前面的写入后再写），写入后即释放该上游的条目列表
+    """
+    async def fetchOne(k, url):
+        return k, await FetchSource(client, url, maxRetry, retryDelay, cache, blacklist)
+
+    store = CandidateStore()
+    done = {}
+    nextIndex = 0
+    matched = 0
+    stats = {"total": 0, "unmatched": 0, "blacklisted": 0, "ipv6": 0}
+    with Metrics.Track("fetch"):
+        for future in asyncio.as_completed([fetchOne(k, url) for k, url in enumerate(sources)]):
+            k, (url, items, srcStats, success) = await future
+            for key in stats:
+                stats[key] += srcStats.get(key, 0)
+            done[k] = (url, items)
+            while nextIndex in done:
+                url, items = done.pop(nextIndex)
+                matched += AddSourceItems(store, GetSourceName(url), items)
+                nextIndex += 1
+
+    if cache:
+        cache.Prune(sources)
+
+    Log(f"共抓取 {stats['total']} 个频道，匹配 {matched} 个")
+    if stats["blacklisted"] > 0:
+        Log(f"黑名单过滤: {stats['blacklisted']} 个源")
+    if stats["ipv6"] > 0:
+        Log(f"IPv6 过滤: {stats['ipv6']} 个源")
+
+    return store
 
-    allItems = []
-    for url, items, success in results:
-        allItems.extend(items)
 
-    return allItems
+def ParseM3U(content):
+    """解析 m3u 文本（不筛选），返回 [{"name", "url"}, ...]"""
+    parser = M3UStreamParser(filterChannels=False)
+    parser.Feed(content.encode("utf-8"))
+    parser.Close()
+    return parser.items
 
 
-def ParseM3U(content):
-    """解析 m3u 文件"""
-    items = []
-    lines = content.strip().split("\n")
-    i = 0
-    while i < len(lines):
-        line = lines[i].strip()
-        if line.startswith("#EXTINF:"):
-            match = re.search(r',(.+)$', line)
-            if match and i + 1 < len(lines):
-                name = match.group(1).strip()
-                url = lines[i + 1].strip()
-                if "#" in url:
-                    url = url.split("#")[0]
-                if url and not url.startswith("#"):
-                    items.append({"name": name, "url": url})
-                i += 1
-        i += 1
-    return items
+# ==================== 候选存储 ====================
+
+class CandidateStore:
+    """紧凑候选存储：上游条目插入时按 URL 去重，按列保存，百万条目时不生成大量小对象
+    - url -> 序号；频道 ID 和来源名映射为小整数，来源名只保存一份
+    - 每个 URL 的第一个 (频道, 来源) 存在 array 列中，同一 URL 还属于其他频道时放在 extra
+    - 测速结果按序号存在并行 array 中（InitScores 分配）：状态、TTFB、速度、深度验证、直播检查
+    - aliases: {url: 代表 URL}，DNS 预解析发现的同地址镜像，测速时与代表 URL 同组、互为回退
+    """
+
+    __slots__ = ("urls", "index", "channelNames", "channelIndex", "sourceNames", "sourceIndex",
+                 "channel", "source", "extra", "aliases",
+                 "status", "ttfb", "speed", "speedStd", "verified", "resolution", "fresh", "realtime", "risk")
+
+    # status 取值
+    Untested, Failed, Passed = 0, 1, 2
+
+    def __init__(self):
+        self.urls = []
+        self.index = {}
+        self.channelNames = []
+        self.channelIndex = {}
+        self.sourceNames = []
+        self.sourceIndex = {}
+        self.channel = array("H")
+        self.source = array("H")
+        self.extra = {}  # 序号 -> [(频道号, 来源号), ...]
+        self.aliases = {}
+        self.status = None
+
+    def __len__(self):
+        return len(self.urls)
+
+    @staticmethod
+    def _Id(names, index, name):
+        i = index.get(name)
+        if i is None:
+            i = index[name] = len(names)
+            names.append(name)
+        return i
+
+    def Add(self, chId, url, src):
+        """添加候选，同一 URL 在同一频道只保留第一次出现的来源，返回是否新增"""
+        ch = self._Id(self.channelNames, self.channelIndex, chId)
+        i = self.index.get(url)
+        if i is None:
+            self.index[url] = len(self.urls)
+            self.urls.append(url)
+            self.channel.append(ch)
+            self.source.append(self._Id(self.sourceNames, self.sourceIndex, src))
+            return True
+        if self.channel[i] == ch:
+            return False
+        extra = self.extra.get(i)
+        if extra and any(c == ch for c, _ in extra):
+            return False
+        self.extra.setdefault(i, []).append((ch, self._Id(self.sourceNames, self.sourceIndex, src)))
+        return True
+
+    def Members(self, i):
+        """第 i 个 URL 所属的 [(chId, 来源名), ...]"""
+        members = [(self.channelNames[self.channel[i]], self.sourceNames[self.source[i]])]
+        for ch, src in self.extra.get(i, ()):
+            members.append((self.channelNames[ch], self.sourceNames[src]))
+        return members
+
+    def Items(self):
+        """按插入顺序遍历 (chId, url, 来源名)"""
+        for i, url in enumerate(self.urls):
+            for chId, src in self.Members(i):
+                yield chId, url, src
+
+    def Entries(self):
+        """条目总数（一个 URL 属于多个频道时分别计数）"""
+        return len(self.urls) + sum(len(extra) for extra in self.extra.values())
+
+    def ByChannel(self, limit=0):
+        """返回 {chId: [url, ...]}，limit > 0 时每个频道最多取前 limit 个"""
+        result = {}
+        for chId, url, _ in self.Items():
+            urls = result.setdefault(chId, [])
+            if not limit or len(urls) < limit:
+                urls.append(url)
+        return result
+
+    def Rebuild(self, func):
+        """按 func(chId, url) 生成新的存储：返回新 URL（可以是同组的代表 URL）保留，返回 None 丢弃
+        两端都保留下来的同地址镜像关系带到新存储"""
+        store = CandidateStore()
+        for chId, url, src in self.Items():
+            newUrl = func(chId, url)
+            if newUrl:
+                store.Add(chId, newUrl, src)
+        store.aliases = {url: rep for url, rep in self.aliases.items() if url in store.index and rep in store.index}
+        return store
+
+    def InitScores(self):
+        """测速前分配结果列（未测、未知值为 NaN / -1）"""
+        n = len(self.urls)
+        self.status = bytearray(n)
+        self.ttfb, self.speed, self.speedStd, self.realtime, self.risk = (
+            array("f", [math.nan]) * n for _ in range(5))
+        self.verified, self.fresh = (array("b", [-1]) * n for _ in range(2))
+        self.resolution = array("h", [0]) * n
+
+    def SetTest(self, i, result):
+        """记录连通测速结果，result 为 None 表示失败"""
+        if not result:
+            self.status[i] = self.Failed
+            return
+        self.status[i] = self.Passed
+        self.ttfb[i] = result["ttfb"]
+        self.speed[i] = result["speed"]
+        self.speedStd[i] = result["speedStd"]
+
+    def SetVerify(self, i, passed, resolution, live=None):
+        """记录深度验证和直播检查结果"""
+        self.verified[i] = int(passed)
+        self.resolution[i] = max(-1, min(resolution, 32767))
+        if live:
+            self.fresh[i] = -1 if live["fresh"] is None else int(live["fresh"])
+            self.realtime[i] = math.nan if live["realtime"] is None else live["realtime"]
+            self.risk[i] = math.nan if live["risk"] is None else live["risk"]
+
+    def Result(self, url):
+        """单个 URL 的测速结果 {ttfb, speed, speedStd[, verified, resolution, live]}，未测或失败返回 None"""
+        i = self.index.get(url)
+        if i is None or self.status is None or self.status[i] != self.Passed:
+            return None
+        result = {"ttfb": self.ttfb[i], "speed": self.speed[i], "speedStd": self.speedStd[i]}
+        if self.verified[i] >= 0:
+            result["verified"] = bool(self.verified[i])
+            result["resolution"] = self.resolution[i]
+            if self.fresh[i] >= 0 or not math.isnan(self.risk[i]):
+                result["live"] = {"fresh": None if self.fresh[i] < 0 else bool(self.fresh[i]),
+                                  "realtime": None if math.isnan(self.realtime[i]) else round(self.realtime[i], 3),
+                                  "risk": None if math.isnan(self.risk[i]) else round(self.risk[i], 3)}
+        return result
+
+
+class UrlCanonicalizer:
+    """URL 归一化：按等价规则把同一条流的不同写法映射到同一个 key
+    默认规则：主机名小写、忽略 http/https、去掉默认端口、去掉结尾斜杠、查询参数排序并去掉跟踪参数、
+    运营商 PLTV/8888xxxx 路径段视为等价；可在 设置.URL等价规则 中逐项覆盖
+    """
+
+    Defaults = {
+        "忽略协议": True,
+        "忽略默认端口": True,
+        "忽略结尾斜杠": True,
+        "参数排序": True,
+        "忽略参数": ["utm_source", "utm_medium", "utm_campaign", "utm_term", "utm_content", "spm", "from"],
+        "路径替换": [["/PLTV/\\d+/", "/PLTV/*/"]],
+    }
+
+    def __init__(self, rules=None):
+        rules = {**self.Defaults, **(rules or {})}
+        self.ignoreScheme = rules["忽略协议"]
+        self.ignoreDefaultPort = rules["忽略默认端口"]
+        self.stripSlash = rules["忽略结尾斜杠"]
+        self.sortQuery = rules["参数排序"]
+        self.ignoreParams = set(rules["忽略参数"])
+        self.pathRules = [(re.compile(pattern), repl) for pattern, repl in rules["路径替换"]]
+
+    def Key(self, url):
+        try:
+            parsed = urlparse(url)
+            port = parsed.port
+        except ValueError:
+            return url
+        scheme = parsed.scheme.lower()
+        host = (parsed.hostname or "").lower()
+        if port and not (self.ignoreDefaultPort and port == {"http": 80, "https": 443}.get(scheme)):
+            host = f"{host}:{port}"
+        path = parsed.path or "/"
+        for pattern, repl in self.pathRules:
+            path = pattern.sub(repl, path)
+        if self.stripSlash and len(path) > 1:
+            path = path.rstrip("/")
+        params = [p for p in parsed.query.split("&") if p and p.split("=", 1)[0] not in self.ignoreParams]
+        if self.sortQuery:
+            params.sort()
+        prefix = "" if self.ignoreScheme else scheme + ":"
+        return f"{prefix}//{host}{path}?{'&'.join(params)}"
+
+
+# ==================== 频道匹配 ====================
+
+def NormalizeName(name):
+    """频道名归一化：全角转半角、转大写、去掉空白和连接符（两个数字之间保留，避免 "16 4K" 粘连成 164K）"""
+    name = unicodedata.normalize("NFKC", name).upper()
+    return re.sub(r"(?<!\d)[\s\-_·]+|[\s\-_·]+(?!\d)", "", name)
+
+
+class ChannelMatcher:
+    """频道名匹配器
+    所有别名归一化后构建前缀树，编译为一个正则，一次扫描即可匹配任意数量的频道；
+    同一前缀下较长的别名优先（CCTV5+ 优先于 CCTV5），以数字结尾的别名后面不能再接数字或 +
+    （CCTV1 不匹配 CCTV10/CCTV1+）。结果按原始频道名缓存。
+    """
+
+    MemoLimit = 200000
+
+    def __init__(self, aliases):
+        """aliases: {chId: [别名, ...]}"""
+        self.aliasMap = {}
+        for chId, names in aliases.items():
+            for alias in names:
+                key = NormalizeName(alias)
+                if key:
+                    self.aliasMap.setdefault(key, chId)
+        trie = {}
+        for key in self.aliasMap:
+            node = trie
+            for c in key:
+                node = node.setdefault(c, {})
+            node[""] = "(?![0-9+])" if key[-1].isdigit() else ""
+        self.pattern = re.compile(self._TrieRegex(trie)) if trie else None
+        self.memo = {}
+
+    def _TrieRegex(self, node):
+        alts = [re.escape(c) + self._TrieRegex(child) for c, child in sorted(node.items()) if c]
+        # 终止分支放最后，保证最长匹配优先
+        if "" in node:
+            alts.append(node[""])
+        if len(alts) == 1:
+            return alts[0]
+        return "(?:" + "|".join(alts) + ")"
+
+    def Signature(self):
+        """别名表签名，用于解析结果缓存"""
+        key = json.dumps(sorted(self.aliasMap.items()), ensure_ascii=False)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+    def Match(self, name):
+        if name in self.memo:
+            return self.memo[name]
+        chId = None
+        if self.pattern:
+            m = self.pattern.search(NormalizeName(name))
+            if m:
+                chId = self.aliasMap[m.group(0)]
+        if len(self.memo) >= self.MemoLimit:
+            self.memo.clear()
+        self.memo[name] = chId
+        return chId
 
 
 def MatchChannel(name):
     """匹配频道名到标准频道 ID"""
-    upper = name.upper()
-    for pattern, chId in ChannelPatterns:
-        if re.search(pattern, upper, re.IGNORECASE):
-            return chId
-    return None
+    return Matcher.Match(name) if Matcher else None
 
 
 def IsBlacklisted(url, blacklist):
@@ -209,62 +1337,297 @@ def IsIPv6Url(url):
     return False
 
 
-def FilterChannels(allItems, blacklist=None):
-    """筛选 CCTV 频道，返回 {chId: [(url, source), ...]}"""
-    if blacklist is None:
-        blacklist = []
-    result = {ch: [] for ch in Channels}
-    blacklisted = 0
-    ipv6Filtered = 0
-    for item in allItems:
-        url = item["url"]
-        if IsBlacklisted(url, blacklist):
-            blacklisted += 1
+def AddSourceItems(store, src, items):
+    """把一个上游已筛选的 (url, chId) 条目写入 CandidateStore（插入时去重），返回条目数
+    黑名单和 IPv6 已由 M3UStreamParser 过滤（解析缓存按筛选条件区分），这里不再重复检查
+    """
+    for url, chId in items:
+        if chId in Channels:
+            store.Add(chId, url, src)
+    return len(items)
+
+
+async def DedupeByAddress(client, store, maxConcur=64):
+    """测速前预解析所有主机（只取 IPv4），过滤没有 A 记录的源，返回新的 CandidateStore；
+    属于相同频道、(IP, 端口, 路径, 查询串) 相同的 URL 记为同地址镜像（store.aliases，指向第一个出现的 URL）。
+    镜像不从候选中删除：同一 IP 上的虚拟主机可能按 Host 提供不同内容，
+    测速时镜像与代表 URL 同组，只测第一个，失败时按顺序回退（与 URL 归一化分组一致）
+    """
+    hosts = {urlparse(url).hostname for url in store.urls} - {None}
+    sem = asyncio.Semaphore(maxConcur)
+
+    async def resolveOne(host):
+        async with sem:
+            return host, await client.resolver.Lookup(host)
+
+    start = time.time()
+    addrs = dict(await asyncio.gather(*(resolveOne(host) for host in hosts)))
+    groups = {}  # (ip, port, path, query, 频道) -> 代表 URL
+    reps = {}  # url -> 代表 URL，无 IPv4 地址的不在其中
+    merged = 0
+    for i, url in enumerate(store.urls):
+        parsed = urlparse(url)
+        ips = addrs.get(parsed.hostname)
+        if not ips:
             continue
-        # 过滤 IPv6 源
-        if IsIPv6Url(url):
-            ipv6Filtered += 1
+        try:
+            port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        except ValueError:
             continue
-        chId = MatchChannel(item["name"])
-        if chId:
-            result[chId].append((url, item.get("source", "unknown")))
-    if blacklisted > 0:
-        Log(f"黑名单过滤: {blacklisted} 个源")
-    if ipv6Filtered > 0:
-        Log(f"IPv6 过滤: {ipv6Filtered} 个源")
-    return result
+        channels = frozenset(chId for chId, _ in store.Members(i))
+        rep = reps[url] = groups.setdefault((min(ips), port, parsed.path, parsed.query, channels), url)
+        if rep != url:
+            merged += 1
+    dropped = len(store) - len(reps)
+    noAddr = sum(1 for ips in addrs.values() if not ips)
+    Log(f"DNS 预解析: {len(hosts)} 个主机 ({time.time() - start:.1f}s)，{noAddr} 个无 IPv4 地址，"
+        f"过滤 {dropped} 个 URL，同地址镜像 {merged} 个（测速时作为回退）")
+    Metrics.Set("dnsHosts", len(hosts))
+    Metrics.Set("dnsNoAddress", noAddr)
+    Metrics.Set("addressMerged", merged)
+    if dropped:
+        store = store.Rebuild(lambda chId, url: url if url in reps else None)
+    store.aliases = {url: rep for url, rep in reps.items() if rep != url}
+    return store
+
+
+# ==================== 历史质量库 ====================
+
+HistoryFile = RootDir / "history.db"
+
+
+class HistoryStore:
+    """URL 历史质量库（SQLite）
+    通过/失败次数按半衰期指数衰减，分数 = 衰减后的通过率（拉普拉斯平滑，新 URL 为 0.5）
+    """
+
+    def __init__(self, path=HistoryFile, halfLife=24 * 3600):
+        self.path = path
+        self.halfLife = halfLife
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS history (
+                url TEXT PRIMARY KEY,
+                passW REAL NOT NULL DEFAULT 0,
+                failW REAL NOT NULL DEFAULT 0,
+                consecFails INTEGER NOT NULL DEFAULT 0,
+                ttfb REAL,
+                speed REAL,
+                speedStd REAL,
+                resolution INTEGER,
+                audioOnly INTEGER NOT NULL DEFAULT 0,
+                lastPass REAL,
+                lastFail REAL,
+                updated REAL NOT NULL
+            )
+        """)
+        self.conn.row_factory = sqlite3.Row
+        self.rows = {row["url"]: dict(row) for row in self.conn.execute("SELECT * FROM history")}
+        self.pending = {}
+
+    def Close(self):
+        self.conn.close()
+
+    def _Decay(self, row, now):
+        """返回衰减到 now 的 (passW, failW)"""
+        factor = 0.5 ** (max(0, now - row["updated"]) / self.halfLife)
+        return row["passW"] * factor, row["failW"] * factor
+
+    def Score(self, url, now=None):
+        """衰减后的通过率，0~1"""
+        row = self.rows.get(url)
+        if not row:
+            return 0.5
+        passW, failW = self._Decay(row, now or time.time())
+        return (passW + 1) / (passW + failW + 2)
+
+    def ShouldSkip(self, url, maxFails, retryAfter, now=None):
+        """连续失败达到上限且未到重测时间则跳过，重测间隔随失败次数翻倍（最长 7 天）"""
+        row = self.rows.get(url)
+        if not row or row["consecFails"] < maxFails or not row["lastFail"]:
+            return False
+        wait = min(retryAfter * 2 ** (row["consecFails"] - maxFails), 7 * 86400)
+        return (now or time.time()) - row["lastFail"] < wait
+
+    def Plan(self, store, maxFails, retryAfter):
+        """按历史分数降序排列 CandidateStore 中待测 URL 的序号，跳过持续失败的 URL，返回 (序号列表, skipped)
+        某频道全部候选都会被跳过时，该频道不跳过，避免丢频道
+        """
+        now = time.time()
+        skip = {i for i, url in enumerate(store.urls) if self.ShouldSkip(url, maxFails, retryAfter, now)}
+
+        if skip:
+            covered = set()  # 有未跳过候选的频道
+            for i in range(len(store)):
+                if i not in skip:
+                    covered.update(chId for chId, _ in store.Members(i))
+            skip = {i for i in skip if all(chId in covered for chId, _ in store.Members(i))}
+
+        order = [i for i in range(len(store)) if i not in skip]
+        order.sort(key=lambda i: self.Score(store.urls[i], now), reverse=True)
+        return order, len(skip)
+
+    def Record(self, url, passed, **metrics):
+        """记录本次测试结果（后一阶段覆盖前一阶段），Flush 时统一写入"""
+        entry = self.pending.setdefault(url, {})
+        entry.update(metrics)
+        entry["passed"] = passed
+
+    def Flush(self):
+        """将本次运行结果写入数据库"""
+        now = time.time()
+        for url, entry in self.pending.items():
+            row = self.rows.get(url) or {
+                "url": url, "passW": 0.0, "failW": 0.0, "consecFails": 0,
+                "ttfb": None, "speed": None, "speedStd": None, "resolution": None,
+                "audioOnly": 0, "lastPass": None, "lastFail": None, "updated": now,
+            }
+            passW, failW = self._Decay(row, now)
+            if entry["passed"]:
+                passW += 1
+                row["consecFails"] = 0
+                row["lastPass"] = now
+            else:
+                failW += 1
+                row["consecFails"] += 1
+                row["lastFail"] = now
+            row["passW"], row["failW"], row["updated"] = passW, failW, now
+            for key in ("ttfb", "speed", "speedStd", "resolution"):
+                if entry.get(key) is not None:
+                    row[key] = entry[key]
+            if "audioOnly" in entry:
+                row["audioOnly"] = int(entry["audioOnly"])
+            self.rows[url] = row
+
+        if self.pending:
+            cols = ["url", "passW", "failW", "consecFails", "ttfb", "speed", "speedStd",
+                    "resolution", "audioOnly", "lastPass", "lastFail", "updated"]
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO history ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+                [tuple(self.rows[url][c] for c in cols) for url in self.pending],
+            )
+            self.conn.commit()
+        count = len(self.pending)
+        self.pending = {}
+        return count
+
+    def Prune(self, days):
+        """删除超过 days 天未更新的记录，返回删除条数"""
+        cutoff = time.time() - days * 86400
+        cur = self.conn.execute("DELETE FROM history WHERE updated < ?", (cutoff,))
+        self.conn.commit()
+        self.rows = {url: row for url, row in self.rows.items() if row["updated"] >= cutoff}
+        return cur.rowcount
+
+
+def ShowHistory(limit=30, keyword=None, worst=False):
+    """命令行查看历史质量库"""
+    store = HistoryStore()
+    now = time.time()
+    rows = [r for r in store.rows.values() if not keyword or keyword in r["url"]]
+    rows.sort(key=lambda r: store.Score(r["url"], now), reverse=not worst)
+    print(f"共 {len(store.rows)} 条记录，显示 {min(limit, len(rows))} 条")
+    print(f"{'分数':>6} {'连败':>4} {'延迟ms':>7} {'速度KB/s':>9} {'分辨率':>6} {'最近通过':<16} URL")
+    for r in rows[:limit]:
+        ttfb = f"{r['ttfb'] * 1000:.0f}" if r["ttfb"] is not None else "-"
+        speed = f"{r['speed'] / 1024:.0f}" if r["speed"] is not None else "-"
+        res = "音频" if r["audioOnly"] else (f"{r['resolution']}p" if r["resolution"] else "-")
+        lastPass = datetime.fromtimestamp(r["lastPass"]).strftime("%m-%d %H:%M") if r["lastPass"] else "-"
+        print(f"{store.Score(r['url'], now):6.2f} {r['consecFails']:4d} {ttfb:>7} {speed:>9} {res:>6} {lastPass:<16} {r['url']}")
+    store.Close()
+
+
+def PruneHistory(days):
+    """命令行清理历史质量库"""
+    store = HistoryStore()
+    removed = store.Prune(days)
+    store.conn.execute("VACUUM")
+    store.Close()
+    print(f"已删除 {removed} 条超过 {days} 天未更新的记录")
 
 
 # ==================== 测速模块（参考 iptv-api 优化） ====================
 
-async def AioFetch(url, timeout=10):
-    """使用 aiohttp 获取内容"""
-    connector = aiohttp.TCPConnector()
+async def AioFetch(client, url, timeout=10):
+    """使用共享客户端获取内容，有运行缓存时优先读缓存"""
+    if client.cache:
+        cache = client.cache
+        return await cache.Load(("playlist", url), lambda: _AioFetch(client, url, timeout), cache.PlaylistTtl)
+    return await _AioFetch(client, url, timeout)
+
+
+async def _AioFetch(client, url, timeout):
     try:
-        async with aiohttp.ClientSession(connector=connector, trust_env=False) as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout), ssl=False) as resp:
-                if resp.status == 200:
-                    return await resp.text()
-    except:
+        async with client.Get(url, timeout=timeout) as resp:
+            if resp.status == 200:
+                return await resp.text()
+    except Exception:
         pass
     return None
 
 
-async def AioDownload(url, timeout=10):
-    """使用 aiohttp 下载并返回指标"""
-    connector = aiohttp.TCPConnector()
+# 分片测速预算：每个分片最多读取的字节数 / 秒数（0 为不限），RunOnce 中按配置设置
+MeasureBytes = 1024 * 1024
+MeasureSeconds = 5
+
+# 深度验证每个分片读取的字节数（HTTP Range）
+VerifyBytes = 256 * 1024
+
+# Master 变体选择：实测吞吐需达到声明带宽（BANDWIDTH）的倍数
+VariantMargin = 1.2
+
+# 吞吐滑动窗口（秒）
+ThroughputWindow = 1.0
+
+# 直播检查外层超时相对窗口的余量（秒），LiveCheck 自己控制截止时间，外层只兜底
+LiveCheckSlack = 5
+
+
+async def AioDownload(client, url, timeout=10, keep=False, maxBytes=None, maxSeconds=None, rangeBytes=0):
+    """流式下载分片并返回指标，边收边计数，不在内存中保留整个分片
+    - maxBytes / maxSeconds：读取预算，达到即停止（默认取 MeasureBytes / MeasureSeconds）
+    - rangeBytes > 0 时发送 Range 请求只取开头，服务器不支持（返回 200）时按预算截断
+    - keep=True 时把分片开头缓存供分辨率解析复用
+    返回 {bytes, speed, ttfb, total, throughput, complete}：
+    speed = 字节数 / 总时间（含 TTFB，与整片下载口径一致），throughput 为最后一个滑动窗口的吞吐
+    """
+    maxBytes = MeasureBytes if maxBytes is None else maxBytes
+    maxSeconds = MeasureSeconds if maxSeconds is None else maxSeconds
+    if rangeBytes:
+        maxBytes = min(maxBytes, rangeBytes) if maxBytes else rangeBytes
+    headers = {"Range": f"bytes=0-{rangeBytes - 1}"} if rangeBytes else None
     try:
-        startTime = time.time()
-        async with aiohttp.ClientSession(connector=connector, trust_env=False) as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout), ssl=False) as resp:
-                ttfb = time.time() - startTime
-                if resp.status == 200:
-                    data = await resp.read()
-                    totalTime = time.time() - startTime
-                    size = len(data)
-                    speed = size / totalTime if totalTime > 0 else 0
-                    return {"bytes": size, "speed": speed, "ttfb": ttfb, "total": totalTime}
-    except:
+        async with client.Get(url, timeout=timeout, headers=headers) as resp:
+            ttfb = resp.ttfb
+            startTime = time.time() - ttfb
+            if resp.status not in (200, 206):
+                return None
+            size = 0
+            head = bytearray()
+            window = deque()  # (时间, 累计字节)
+            complete = True
+            async for chunk in resp.content.iter_chunked(65536):
+                size += len(chunk)
+                now = time.time()
+                window.append((now, size))
+                while len(window) > 2 and now - window[1][0] >= ThroughputWindow:
+                    window.popleft()
+                if keep and len(head) < ProbeBytes:
+                    head += chunk[:ProbeBytes - len(head)]
+                if (maxBytes and size >= maxBytes) or (maxSeconds and now - startTime - ttfb >= maxSeconds):
+                    complete = resp.status == 206 or resp.content.at_eof()
+                    break
+            totalTime = time.time() - startTime
+            speed = size / totalTime if totalTime > 0 else 0
+            if len(window) >= 2 and window[-1][0] > window[0][0]:
+                throughput = (window[-1][1] - window[0][1]) / (window[-1][0] - window[0][0])
+            else:
+                throughput = speed
+            if keep and client.cache and head:
+                client.cache.Put(("segment", url), bytes(head), len(head))
+            return {"bytes": size, "speed": speed, "ttfb": ttfb, "total": totalTime,
+                    "throughput": throughput, "complete": complete, "length": resp.content_length or 0}
+    except Exception:
         pass
     return None
 
@@ -285,91 +1648,477 @@ def ParseM3u8Segments(content, baseUrl):
     return segments
 
 
-def ParseResolution(content):
-    """从 Master Playlist 解析最高分辨率，返回高度值（如 1080, 720）"""
-    if "#EXT-X-STREAM-INF" not in content:
+def ParseMediaPlaylist(content):
+    """解析媒体播放列表的直播信息：{sequence, target, ended, durations}，durations 与 ParseM3u8Segments 的分片一一对应"""
+    info = {"sequence": None, "target": 0, "ended": "#EXT-X-ENDLIST" in content, "durations": []}
+    for line in content.split("\n"):
+        line = line.strip()
+        if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            try:
+                info["sequence"] = int(line.split(":", 1)[1])
+            except ValueError:
+                pass
+        elif line.startswith("#EXT-X-TARGETDURATION:"):
+            try:
+                info["target"] = float(line.split(":", 1)[1])
+            except ValueError:
+                pass
+        elif line.startswith("#EXTINF:"):
+            try:
+                info["durations"].append(float(line[8:].split(",", 1)[0]))
+            except ValueError:
+                info["durations"].append(0.0)
+    return info
+
+
+# #EXT-X-STREAM-INF 属性（带引号的值中可以有逗号，如 CODECS="avc1.64001f,mp4a.40.2"）
+StreamInfAttr = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+AudioCodecs = ("mp4a", "ac-3", "ec-3", "opus", "mp3")
+
+
+def ParseVariants(content, baseUrl):
+    """解析 Master Playlist 的全部变体，返回 [{url, bandwidth, height, codecs, audioOnly}, ...]
+    按列表顺序，同一地址只保留第一次出现；不是 Master Playlist 时返回空列表
+    """
+    variants = []
+    seen = set()
+    attrs = None
+    for line in content.split("\n"):
+        line = line.strip()
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            attrs = dict(StreamInfAttr.findall(line[18:]))
+        elif attrs is not None and line and not line.startswith("#"):
+            url = line if line.startswith("http") else urljoin(baseUrl, line)
+            if url not in seen:
+                seen.add(url)
+                match = re.match(r"(\d+)x(\d+)", attrs.get("RESOLUTION", ""))
+                codecs = [c.strip() for c in attrs.get("CODECS", "").strip('"').split(",") if c.strip()]
+                try:
+                    bandwidth = int(attrs.get("BANDWIDTH", 0))
+                except ValueError:
+                    bandwidth = 0
+                variants.append({
+                    "url": url,
+                    "bandwidth": bandwidth,
+                    "height": int(match.group(2)) if match else 0,
+                    "codecs": codecs,
+                    # 声明了 CODECS 且全部是音频编码
+                    "audioOnly": bool(codecs) and all(c.lower().startswith(AudioCodecs) for c in codecs),
+                })
+            attrs = None
+    return variants
+
+
+# ==================== TS 分辨率解析 ====================
+
+# PMT 流类型
+TsVideoTypes = {0x01: "mpeg1", 0x02: "mpeg2", 0x10: "mpeg4", 0x1B: "h264", 0x24: "h265", 0x42: "avs", 0xD2: "avs2", 0xEA: "vc1"}
+TsAudioTypes = {0x03, 0x04, 0x0F, 0x11, 0x81, 0x87}
+
+# 分辨率探测读取上限（字节）
+ProbeBytes = 512 * 1024
+
+# ffprobe 兜底并发上限，RunOnce 中按配置重建
+FfprobeSem = asyncio.Semaphore(4)
+
+
+class BitReader:
+    """按位读取（SPS 解析用）"""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def U(self, n):
+        value = 0
+        for _ in range(n):
+            byte = self.data[self.pos >> 3]
+            value = (value << 1) | ((byte >> (7 - (self.pos & 7))) & 1)
+            self.pos += 1
+        return value
+
+    def Skip(self, n):
+        self.pos += n
+
+    def Ue(self):
+        """无符号指数哥伦布编码"""
+        zeros = 0
+        while self.U(1) == 0:
+            zeros += 1
+            if zeros > 31:
+                raise ValueError("invalid exp-golomb")
+        return (1 << zeros) - 1 + self.U(zeros)
+
+    def Se(self):
+        """有符号指数哥伦布编码"""
+        k = self.Ue()
+        return (k + 1) // 2 if k & 1 else -(k // 2)
+
+
+def RemoveEmulation(nal):
+    """去掉 NAL 中的防竞争字节（00 00 03 -> 00 00）"""
+    return re.sub(rb"\x00\x00\x03(?=[\x00-\x03])", b"\x00\x00", nal)
+
+
+def ParseH264SpsHeight(sps):
+    """解析 H.264 SPS（不含 NAL 头），返回裁剪后的高度"""
+    r = BitReader(RemoveEmulation(sps))
+    profile = r.U(8)
+    r.Skip(16)  # constraint_flags + level_idc
+    r.Ue()  # seq_parameter_set_id
+    chroma = 1
+    separateColour = 0
+    if profile in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma = r.Ue()
+        if chroma == 3:
+            separateColour = r.U(1)
+        r.Ue()  # bit_depth_luma_minus8
+        r.Ue()  # bit_depth_chroma_minus8
+        r.Skip(1)  # qpprime_y_zero_transform_bypass_flag
+        if r.U(1):  # seq_scaling_matrix_present_flag
+            for i in range(8 if chroma != 3 else 12):
+                if r.U(1):
+                    size = 16 if i < 6 else 64
+                    last = nextScale = 8
+                    for _ in range(size):
+                        if nextScale != 0:
+                            nextScale = (last + r.Se() + 256) % 256
+                        last = nextScale if nextScale != 0 else last
+    r.Ue()  # log2_max_frame_num_minus4
+    pocType = r.Ue()
+    if pocType == 0:
+        r.Ue()
+    elif pocType == 1:
+        r.Skip(1)
+        r.Se()
+        r.Se()
+        for _ in range(r.Ue()):
+            r.Se()
+    r.Ue()  # max_num_ref_frames
+    r.Skip(1)  # gaps_in_frame_num_value_allowed_flag
+    r.Ue()  # pic_width_in_mbs_minus1
+    heightMapUnits = r.Ue() + 1
+    frameMbsOnly = r.U(1)
+    if not frameMbsOnly:
+        r.Skip(1)  # mb_adaptive_frame_field_flag
+    r.Skip(1)  # direct_8x8_inference_flag
+    height = (2 - frameMbsOnly) * heightMapUnits * 16
+    if r.U(1):  # frame_cropping_flag
+        r.Ue()
+        r.Ue()
+        top, bottom = r.Ue(), r.Ue()
+        if chroma == 0 or separateColour:
+            unitY = 2 - frameMbsOnly
+        else:
+            unitY = (2 if chroma == 1 else 1) * (2 - frameMbsOnly)
+        height -= unitY * (top + bottom)
+    return height
+
+
+def ParseH265SpsHeight(sps):
+    """解析 H.265 SPS（不含 NAL 头），返回裁剪后的高度"""
+    r = BitReader(RemoveEmulation(sps))
+    r.Skip(4)  # sps_video_parameter_set_id
+    maxSubLayers = r.U(3)
+    r.Skip(1)  # sps_temporal_id_nesting_flag
+    # profile_tier_level
+    r.Skip(88)  # general profile
+    r.Skip(8)  # general_level_idc
+    profilePresent, levelPresent = [], []
+    for _ in range(maxSubLayers):
+        profilePresent.append(r.U(1))
+        levelPresent.append(r.U(1))
+    if maxSubLayers > 0:
+        r.Skip(2 * (8 - maxSubLayers))
+    for i in range(maxSubLayers):
+        if profilePresent[i]:
+            r.Skip(88)
+        if levelPresent[i]:
+            r.Skip(8)
+    r.Ue()  # sps_seq_parameter_set_id
+    chroma = r.Ue()
+    if chroma == 3:
+        r.Skip(1)
+    r.Ue()  # pic_width_in_luma_samples
+    height = r.Ue()
+    if r.U(1):  # conformance_window_flag
+        r.Ue()
+        r.Ue()
+        top, bottom = r.Ue(), r.Ue()
+        height -= (2 if chroma == 1 else 1) * (top + bottom)
+    return height
+
+
+def FindSpsHeight(es, codec):
+    """在视频基本流中查找序列头，返回高度，未找到返回 0"""
+    if codec in ("mpeg1", "mpeg2"):
+        idx = es.find(b"\x00\x00\x01\xb3")
+        if idx >= 0 and idx + 7 <= len(es):
+            return ((es[idx + 5] & 0x0F) << 8) | es[idx + 6]
+        return 0
+    if codec not in ("h264", "h265"):
         return 0
 
-    maxHeight = 0
-    for line in content.strip().split("\n"):
-        if "#EXT-X-STREAM-INF" in line:
-            match = re.search(r'RESOLUTION=(\d+)x(\d+)', line)
-            if match:
-                height = int(match.group(2))
-                maxHeight = max(maxHeight, height)
-    return maxHeight
+    idx = es.find(b"\x00\x00\x01")
+    while idx >= 0:
+        start = idx + 3
+        if start >= len(es):
+            break
+        nxt = es.find(b"\x00\x00\x01", start)
+        header = es[start]
+        if codec == "h264" and header & 0x1F == 7:
+            if nxt < 0 and len(es) - start < 64:
+                break  # SPS 可能不完整，等更多数据
+            try:
+                return ParseH264SpsHeight(es[start + 1:nxt if nxt >= 0 else len(es)])
+            except (IndexError, ValueError):
+                return 0
+        if codec == "h265" and (header >> 1) & 0x3F == 33:
+            if nxt < 0 and len(es) - start < 64:
+                break
+            try:
+                return ParseH265SpsHeight(es[start + 2:nxt if nxt >= 0 else len(es)])
+            except (IndexError, ValueError):
+                return 0
+        idx = nxt
+    return 0
+
+
+def ProbeTsResolution(data):
+    """纯 Python 解析 MPEG-TS：PAT -> PMT -> 视频 PES -> SPS
+    返回值：
+        > 0: 视频高度
+        0: 无法确定（数据不足或编码不支持，交给 ffprobe）
+        -1: PMT 中只有音频流
+    """
+    # 查找同步字节
+    offset = -1
+    for i in range(min(188, len(data))):
+        if data[i] == 0x47 and (i + 188 >= len(data) or data[i + 188] == 0x47):
+            offset = i
+            break
+    if offset < 0:
+        return 0
 
+    pmtPids = set()
+    videoPid = None
+    codec = None
+    hasAudio = False
+    es = bytearray()
 
-async def GetResolutionFromSegment(segUrl, timeout=10):
-    """从 ts 分片获取分辨率（使用 ffprobe）
+    for pos in range(offset, len(data) - 187, 188):
+        pkt = data[pos:pos + 188]
+        if pkt[0] != 0x47:
+            continue
+        pusi = pkt[1] & 0x40
+        pid = ((pkt[1] & 0x1F) << 8) | pkt[2]
+        afc = (pkt[3] >> 4) & 0x03
+        if not afc & 0x01:
+            continue
+        start = 4
+        if afc & 0x02:
+            start += 1 + pkt[4]
+        if start >= 188:
+            continue
+        payload = pkt[start:]
+
+        if pid == 0 and pusi and not pmtPids:
+            # PAT
+            sec = payload[1 + payload[0]:]
+            if len(sec) < 8 or sec[0] != 0x00:
+                continue
+            end = min(3 + (((sec[1] & 0x0F) << 8) | sec[2]) - 4, len(sec))
+            for i in range(8, end - 3, 4):
+                program = (sec[i] << 8) | sec[i + 1]
+                if program != 0:
+                    pmtPids.add(((sec[i + 2] & 0x1F) << 8) | sec[i + 3])
+        elif pid in pmtPids and pusi and videoPid is None:
+            # PMT
+            sec = payload[1 + payload[0]:]
+            if len(sec) < 12 or sec[0] != 0x02:
+                continue
+            end = min(3 + (((sec[1] & 0x0F) << 8) | sec[2]) - 4, len(sec))
+            i = 12 + (((sec[10] & 0x0F) << 8) | sec[11])
+            while i + 5 <= end:
+                streamType = sec[i]
+                esPid = ((sec[i + 1] & 0x1F) << 8) | sec[i + 2]
+                if streamType in TsVideoTypes and videoPid is None:
+                    videoPid, codec = esPid, TsVideoTypes[streamType]
+                elif streamType in TsAudioTypes:
+                    hasAudio = True
+                i += 5 + (((sec[i + 3] & 0x0F) << 8) | sec[i + 4])
+            if videoPid is None:
+                return -1 if hasAudio else 0
+        elif pid == videoPid:
+            if pusi:
+                # 跳过 PES 头
+                if len(payload) < 9 or payload[:3] != b"\x00\x00\x01":
+                    continue
+                payload = payload[9 + payload[8]:]
+            elif not es:
+                continue
+            es += payload
+            height = FindSpsHeight(es, codec)
+            if height > 0:
+                return height
+            if len(es) > ProbeBytes:
+                break
+    return 0
+
+
+async def FfprobeResolution(data, timeout=5):
+    """ffprobe 兜底：通过 stdin 传入分片数据，受 FfprobeSem 限制并发"""
+    async with FfprobeSem:
+        with Metrics.Track("ffprobe"):
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    "ffprobe", "-v", "error", "-show_entries", "stream=codec_type,height",
+                    "-of", "csv=p=0", "-i", "pipe:0",
+                    stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL,
+                )
+            except FileNotFoundError:
+                return 0
+            try:
+                stdout, _ = await asyncio.wait_for(proc.communicate(data), timeout)
+            except (asyncio.TimeoutError, BrokenPipeError, ConnectionResetError):
+                return 0
+            finally:
+                # 超时或被取消（竞速落败）时结束子进程，不留下孤儿 ffprobe
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+
+    if proc.returncode != 0:
+        return 0
+    streams = [line.split(",") for line in stdout.decode(errors="replace").split()]
+    videos = [s for s in streams if s[0] == "video"]
+    if not videos:
+        # 有流但没有视频流（只有音频）
+        return -1 if streams else 0
+    for stream in videos:
+        if len(stream) > 1 and stream[1].isdigit():
+            return int(stream[1])
+    return 0
+
+
+async def GetResolutionFromSegment(client, segUrl, timeout=10):
+    """从 ts 分片获取分辨率：只读取前 ProbeBytes 字节，在内存中解析 PAT/PMT/SPS，
+    解析失败时才用 ffprobe 兜底
     返回值：
         > 0: 视频高度（如 1080, 720）
-        0: 未知（ffprobe 失败但可能有视频）
+        0: 未知（解析失败但可能有视频）
         -1: 确认无视频流（只有音频）
     """
-    try:
-        # 下载分片到临时文件
-        connector = aiohttp.TCPConnector()
-        async with aiohttp.ClientSession(connector=connector, trust_env=False) as session:
-            async with session.get(segUrl, timeout=aiohttp.ClientTimeout(total=timeout), ssl=False) as resp:
-                if resp.status != 200:
-                    return 0
-                data = await resp.read()
-                if len(data) < 1000:
-                    return 0
-
-        # 写入临时文件
-        with tempfile.NamedTemporaryFile(suffix=".ts", delete=False) as f:
-            f.write(data)
-            tmpPath = f.name
+    cached = client.cache.Get(("segment", segUrl)) if client.cache else None
+    if cached:
+        resolution = ProbeTsResolution(cached)
+        return resolution if resolution != 0 else await FfprobeResolution(cached)
 
-        try:
-            # 先检查是否有视频流
-            checkResult = subprocess.run(
-                ["ffprobe", "-v", "error", "-select_streams", "v",
-                 "-show_entries", "stream=codec_type", "-of", "csv=p=0", tmpPath],
-                capture_output=True, text=True, timeout=5
-            )
-            # 没有视频流（只有音频）
-            if checkResult.returncode == 0 and not checkResult.stdout.strip():
-                return -1
-
-            # 有视频流，获取分辨率
-            result = subprocess.run(
-                ["ffprobe", "-v", "error", "-select_streams", "v:0",
-                 "-show_entries", "stream=height", "-of", "csv=p=0", tmpPath],
-                capture_output=True, text=True, timeout=5
-            )
-            if result.returncode == 0 and result.stdout.strip():
-                return int(result.stdout.strip())
-        finally:
-            os.unlink(tmpPath)
-    except:
+    try:
+        data = bytearray()
+        async with client.Get(segUrl, timeout=timeout) as resp:
+            if resp.status != 200:
+                return 0
+            async for chunk in resp.content.iter_chunked(65536):
+                data += chunk
+                if len(data) >= 65536:
+                    resolution = ProbeTsResolution(data)
+                    if resolution != 0:
+                        return resolution
+                if len(data) >= ProbeBytes:
+                    break
+        if len(data) < 1000:
+            return 0
+
+        resolution = ProbeTsResolution(data)
+        if resolution != 0:
+            return resolution
+        return await FfprobeResolution(bytes(data))
+    except Exception:
         pass
     return 0
 
 
-async def TestUrl(url, timeout=30):
-    """测试单个 URL：下载前 5 个 ts 分片（参考 iptv-api）"""
-    # 获取 m3u8 内容
-    content = await AioFetch(url, timeout=10)
+async def ResolveMediaPlaylist(client, url, timeout=10):
+    """获取媒体播放列表，Master Playlist 跟随 TestUrl 选中的变体（未测速时跟随第一个变体）
+    返回 (content, mediaUrl, variantResolution)，variantResolution 为所跟随变体声明的高度，失败时 content 为 None；
+    第一个变体的地址缓存在运行缓存中，各阶段不重复解析 Master
+    """
+    chosen = client.variants.get(url)
+    if chosen:
+        subUrl, resolution = chosen
+        return await AioFetch(client, subUrl, timeout), subUrl, resolution
+
+    cache = client.cache
+    variant = cache.Get(("variant", url)) if cache else None
+    if variant:
+        subUrl, resolution = variant
+        return await AioFetch(client, subUrl, timeout), subUrl, resolution
+
+    content = await AioFetch(client, url, timeout)
     if not content:
-        return None
+        return None, url, 0
 
     # 处理 Master Playlist
     if "#EXT-X-STREAM-INF" in content:
-        lines = content.strip().split("\n")
-        for i, line in enumerate(lines):
-            if "#EXT-X-STREAM-INF" in line and i + 1 < len(lines):
-                subUrl = lines[i + 1].strip()
-                if not subUrl.startswith("http"):
-                    subUrl = urljoin(url, subUrl)
-                content = await AioFetch(subUrl, timeout=10)
-                if not content:
-                    return None
-                url = subUrl
-                break
+        variants = ParseVariants(content, url)
+        if variants:
+            subUrl, resolution = variants[0]["url"], variants[0]["height"]
+            if cache:
+                cache.Put(("variant", url), (subUrl, resolution), len(subUrl))
+            return await AioFetch(client, subUrl, timeout), subUrl, resolution
+
+    return content, url, 0
+
+
+async def TestUrl(client, url, timeout=30):
+    """测试单个 URL：下载前 5 个 ts 分片（参考 iptv-api）
+    Master Playlist 并发测试全部变体（TestVariants），媒体播放列表直接测速
+    """
+    content = await AioFetch(client, url, timeout=10)
+    if not content:
+        return None
+    if "#EXT-X-STREAM-INF" in content:
+        variants = ParseVariants(content, url)
+        if variants:
+            return await TestVariants(client, url, variants, timeout)
+    return await TestMedia(client, content, url)
+
+
+async def TestVariants(client, url, variants, timeout=30):
+    """逐个测速 Master Playlist 的各变体（有多个时每个下载 3 个分片），从最高分辨率（同分辨率带宽高的）开始，
+    第一个聚合吞吐不低于声明带宽 × VariantMargin 的变体即选中，都不满足时取声明带宽最低的可用变体；
+    纯音频变体只在没有视频变体时参与。
+    变体之间不并发，每个变体的分片同时下载、按总字节 / 总耗时计算聚合吞吐：各变体不互相抢带宽，
+    共享瓶颈链路上也不会因为单连接速率被摊薄而把高码率变体判为跟不上。
+    选择记入 client.variants，后续深度验证、直播检查都跟随该变体；结果附带 variant、bandwidth、resolution
+    """
+    video = [v for v in variants if not v["audioOnly"]] or variants
+    count = 5 if len(video) == 1 else 3
+
+    passed = []
+    chosen = None
+    for v in sorted(video, key=lambda v: (v["height"], v["bandwidth"]), reverse=True):
+        content = await AioFetch(client, v["url"], timeout=10)
+        r = await TestMedia(client, content, v["url"], count) if content else None
+        if not r:
+            continue
+        passed.append((v, r))
+        if r["aggregate"] * 8 >= v["bandwidth"] * VariantMargin:
+            chosen = (v, r)
+            break
+    if not passed:
+        client.variants.pop(url, None)
+        return None
+    v, r = chosen or min(passed, key=lambda p: p[0]["bandwidth"])
+    client.variants[url] = (v["url"], v["height"])
+    return {**r, "variant": v["url"], "bandwidth": v["bandwidth"], "resolution": v["height"]}
+
 
+async def TestMedia(client, content, url, count=5):
+    """媒体播放列表测速：并发下载前 count 个分片，至少 2 个成功，返回 {speed, ttfb, bytes, segments, speedStd, throughput, aggregate}
+    throughput 为各连接滑动窗口吞吐的均值，aggregate 为成功分片总字节 / 最慢成功分片的耗时（同时下载的聚合吞吐）"""
     # 验证有分片
     if "#EXTINF" not in content:
         return None
@@ -379,9 +2128,9 @@ async def TestUrl(url, timeout=30):
     if not segments:
         return None
 
-    # 并发下载前 5 个分片
-    testSegs = segments[:5]
-    tasks = [AioDownload(seg, timeout=10) for seg in testSegs]
+    # 并发下载前 count 个分片
+    testSegs = segments[:count]
+    tasks = [AioDownload(client, seg, timeout=10) for seg in testSegs]
     segResults = await asyncio.gather(*tasks)
     results = [r for r in segResults if r]
 
@@ -399,44 +2148,30 @@ async def TestUrl(url, timeout=30):
     variance = sum((s - avgSpd) ** 2 for s in speeds) / len(speeds) if len(speeds) > 1 else 0
     speedStd = variance ** 0.5
 
+    # 分片同时开始下载，最慢一个成功分片的耗时即聚合时间（不计失败分片的超时）
+    wall = max(r["total"] for r in results)
+
     return {
         "speed": avgSpeed,
         "ttfb": avgTtfb,
         "bytes": totalBytes,
         "segments": len(results),
-        "speedStd": speedStd
+        "speedStd": speedStd,
+        "throughput": sum(r["throughput"] for r in results) / len(results),
+        "aggregate": totalBytes / wall if wall > 0 else 0,
     }
 
 
-async def DeepVerify(url, timeout=10):
+async def DeepVerify(client, url, timeout=10):
     """深度验证：下载 3 个随机分片，返回 (是否通过, 分辨率高度)
     分辨率返回值：
         > 0: 有视频，返回高度
         0: 未知（可能有视频）
         -1: 只有音频，无视频（会被过滤）
     """
-    content = await AioFetch(url, timeout=5)
-    if not content:
-        return False, 0
-
-    # 尝试从 Master Playlist 解析分辨率
-    resolution = ParseResolution(content)
-
-    # 处理 Master Playlist
-    if "#EXT-X-STREAM-INF" in content:
-        lines = content.strip().split("\n")
-        for i, line in enumerate(lines):
-            if "#EXT-X-STREAM-INF" in line and i + 1 < len(lines):
-                subUrl = lines[i + 1].strip()
-                if not subUrl.startswith("http"):
-                    subUrl = urljoin(url, subUrl)
-                content = await AioFetch(subUrl, timeout=5)
-                if not content:
-                    return False, 0
-                url = subUrl
-                break
-
-    if "#EXTINF" not in content:
+    # 获取 m3u8 内容，同时从 Master Playlist 取所跟随变体声明的分辨率
+    content, url, resolution = await ResolveMediaPlaylist(client, url, timeout=5)
+    if not content or "#EXTINF" not in content:
         return False, 0
 
     segments = ParseM3u8Segments(content, url)
@@ -446,17 +2181,22 @@ async def DeepVerify(url, timeout=10):
     # 随机选择 3 个不同分片
     testSegs = random.sample(segments, min(3, len(segments)))
 
-    # 并发下载，全部成功才算通过
-    tasks = [AioDownload(seg, timeout=timeout) for seg in testSegs]
+    # 并发下载，全部成功才算通过（第一个分片留给分辨率解析复用）
+    # 用 Range 只取开头验证（第一个分片取足够解析分辨率的长度）
+    tasks = [
+        AioDownload(client, seg, timeout=timeout, keep=i == 0, rangeBytes=ProbeBytes if i == 0 else VerifyBytes)
+        for i, seg in enumerate(testSegs)
+    ]
     results = await asyncio.gather(*tasks)
 
     for r in results:
         if not r or r["bytes"] < 1000:
             return False, 0
 
-    # 如果没有从 Master Playlist 获取到分辨率，用 ffprobe 解析分片
-    if resolution == 0 and segments:
-        resolution = await GetResolutionFromSegment(segments[0], timeout=10)
+    # 如果没有从 Master Playlist 获取到分辨率，解析已下载的分片
+    if resolution == 0:
+        with Metrics.Track("probe"):
+            resolution = await GetResolutionFromSegment(client, testSegs[0], timeout=10)
         # 只有音频没有视频，标记为失败
         if resolution == -1:
             return False, -1
@@ -464,116 +2204,539 @@ async def DeepVerify(url, timeout=10):
     return True, resolution
 
 
-async def SelectBestSources(chDict, timeout=30, maxConcur=100, hdLatencyLimit=2):
-    """为每个频道选择最优源"""
-    # 构建 URL -> [(chId, src), ...] 映射，实现全局去重
-    urlMap = {}
-    for chId, urlList in chDict.items():
-        for url, src in urlList:
-            if url not in urlMap:
-                urlMap[url] = []
-            urlMap[url].append((chId, src))
+async def LiveCheck(client, url, window=8, timeout=10):
+    """直播边缘检查：在 window 秒内轮询媒体播放列表，测量持续实时下载能力
+    - 各次请求都受窗口截止时间限制，不超出配置的 window；窗口内放不下一次重新拉取时 fresh 为 None（未知）
+    - fresh: 等待超过一个分片时长后 #EXT-X-MEDIA-SEQUENCE 是否前进（窗口不足一个分片时长为 None，点播列表为 False）
+    - realtime: 最新分片下载时间 / #EXTINF 时长（< 1 才能跟上直播），按预算截断时用 Content-Length 估算整片
+    - risk: 卡顿风险 0~1，由各次实时比的均值和波动估计超过 1 的概率，停更为 1，没有样本为 None
+    播放列表获取失败返回 None
+    """
+    start = time.time()
+    content, mediaUrl, _ = await ResolveMediaPlaylist(client, url, timeout=5)
+    if not content or "#EXTINF" not in content:
+        return None
+    info = ParseMediaPlaylist(content)
+    if info["ended"]:
+        return {"fresh": False, "realtime": None, "risk": 1.0}
+
+    target = info["target"] or (info["durations"][-1] if info["durations"] else 0)
+    deadline = start + window
+    ratios = []
+
+    async def sample(content, info):
+        """下载直播边缘分片，记录实时比（下载时间不超过窗口剩余时间）"""
+        segments = ParseM3u8Segments(content, mediaUrl)
+        if not segments or not info["durations"]:
+            return
+        duration = info["durations"][-1] or info["target"]
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        r = await AioDownload(client, segments[-1], timeout=min(timeout, remaining),
+                              maxSeconds=min(MeasureSeconds or remaining, remaining))
+        if not r or not duration or not r["bytes"]:
+            return
+        total = r["total"]
+        if not r["complete"] and r["length"] > r["bytes"]:
+            total = r["ttfb"] + (total - r["ttfb"]) * r["length"] / r["bytes"]
+        elif not r["complete"]:
+            return
+        ratios.append(total / duration)
+
+    await sample(content, info)
+
+    # 等待一个分片时长后重新拉取（绕过运行缓存），检查序号是否前进
+    # 等待时间扣除重新拉取和采样的预留（按第一轮拉取 + 采样的实际耗时估计）
+    fresh = None
+    reserve = max(1.0, time.time() - start)
+    wait = min(target, deadline - time.time() - reserve)
+    if target and wait > 0:
+        await asyncio.sleep(wait)
+        content2 = await _AioFetch(client, mediaUrl, timeout=max(0.5, min(5, deadline - time.time())))
+        if content2:
+            info2 = ParseMediaPlaylist(content2)
+            if info["sequence"] is not None and info2["sequence"] is not None:
+                advanced = info2["sequence"] > info["sequence"]
+                # 不足一个分片时长内不前进不算停更
+                fresh = True if advanced else (False if wait >= target else None)
+            if fresh is not False:
+                await sample(content2, info2)
+
+    if fresh is False:
+        return {"fresh": False, "realtime": round(max(ratios), 3) if ratios else None, "risk": 1.0}
+    if not ratios:
+        return {"fresh": fresh, "realtime": None, "risk": None}
+    mean = sum(ratios) / len(ratios)
+    std = max((sum((r - mean) ** 2 for r in ratios) / len(ratios)) ** 0.5, 0.1 * mean, 0.05)
+    risk = 0.5 * math.erfc((1 - mean) / (std * math.sqrt(2)))
+    return {"fresh": fresh, "realtime": round(max(ratios), 3), "risk": round(risk, 3)}
+
+
+async def LightCheck(client, url, timeout=10):
+    """轻量检查（守护模式）：拉取播放列表，只读取最新分片开头，返回 {ttfb, speed}，失败返回 None"""
+    content, url, _ = await ResolveMediaPlaylist(client, url, timeout=5)
+    if not content or "#EXTINF" not in content:
+        return None
 
-    if not urlMap:
+    segments = ParseM3u8Segments(content, url)
+    if not segments:
+        return None
+
+    # 直播边缘的分片最能反映当前可用性
+    r = await AioDownload(client, segments[-1], timeout=timeout, rangeBytes=VerifyBytes)
+    if not r or r["bytes"] < 1000:
+        return None
+    return {"ttfb": r["ttfb"], "speed": r["speed"]}
+
+
+async def SelectBestSources(client, store, timeout=30, maxConcur=100, hdLatencyLimit=2,
+                            history=None, maxFails=3, retryAfter=6 * 3600, stageConcur=None, minReady=3,
+                            raceK=3, channelBudget=0, ranking=None, liveWindow=0, maxRisk=0.5, canonicalizer=None,
+                            budget=0, stopWhenDecided=True):
+    """为 CandidateStore 中的每个频道选择最优源，提供 history 时按历史分数排序并跳过持续失败的 URL
+    三个阶段组成流水线，用有界队列连接：快速测试通过的 URL 立即进入连通测速，
+    某频道有 minReady 个候选测完（或全部候选已出结果）即开始深度验证。
+    stageConcur: {"quick": n, "test": n, "deep": n} 各阶段并发数，默认与 maxConcur 相同（深度验证默认 32）
+    raceK: 每个频道同时深度验证的候选数；channelBudget: 单频道深度验证时间预算（秒），0 为不限
+    ranking: 传入 dict 时填充 {chId: [url, ...]} 备选排名：最优源、其余验证通过的、未验证的（按延迟），不含验证失败的
+    各 URL 的测速、深度验证、直播检查结果写入 store 的结果列（store.Result(url) 读取）
+    liveWindow > 0 时深度验证同时做直播边缘检查（LiveCheck），停更或卡顿风险超过 maxRisk 的候选视为验证失败
+    canonicalizer: UrlCanonicalizer，归一化后相同的 URL 为一组，只测一个，通过的成员代表整组进入各频道的候选；
+    store.aliases 中的同地址镜像与代表 URL 同组
+    候选组按频道调度：每次派发给可用选项（测速通过且未被验证淘汰的候选 + 在测的候选）最少的频道，
+    stopWhenDecided 时频道决定后不再为它派发；budget > 0 为整个选源的时间预算（秒），
+    用完时停止测速和验证，按已有结果选源
+    """
+    # URL 已在 store 中全局去重，队列里传递序号
+    if not len(store):
         return {}
+    store.InitScores()
 
-    allUrls = list(urlMap.keys())
+    if history:
+        allUrls, skipped = history.Plan(store, maxFails, retryAfter)
+        if skipped > 0:
+            Log(f"历史跳过: {skipped} 个持续失败的 URL")
+    else:
+        allUrls = range(len(store))
     Log(f"待测试: {len(allUrls)} 个唯一 URL")
-    sem = asyncio.Semaphore(maxConcur)
-
-    # 第一步：快速测试（m3u8 有内容）
-    Log(f"--- 快速测试 ---")
-
-    async def quickCheck(url):
-        async with sem:
-            content = await AioFetch(url, timeout=5)
-            return content is not None and ("#EXTINF" in content or "#EXT-X-STREAM-INF" in content)
 
-    tasks = [quickCheck(url) for url in allUrls]
-    results = await asyncio.gather(*tasks)
-    quickUrls = [url for url, ok in zip(allUrls, results) if ok]
-    Log(f"通过: {len(quickUrls)}/{len(allUrls)}")
+    stageConcur = stageConcur or {}
+    quickWorkers = stageConcur.get("quick") or maxConcur
+    testWorkers = stageConcur.get("test") or maxConcur
+    deepSem = asyncio.Semaphore(stageConcur.get("deep") or 32)
+    sem = asyncio.Semaphore(maxConcur)
 
-    if not quickUrls:
-        Log("没有可用源")
-        return {}
+    Log(f"--- 流水线测速 (快速测试 {quickWorkers} / 连通测速 {testWorkers} 并发) ---")
+    startTime = time.time()
+
+    # 等价 URL 分组（归一化后相同，或 DNS 预解析发现的同地址镜像）：每组按历史顺序排列，只测第一个，失败时才回退到下一个
+    groups = {}
+    for i in allUrls:
+        url = store.aliases.get(store.urls[i], store.urls[i])
+        key = canonicalizer.Key(url) if canonicalizer else url
+        groups.setdefault(key, []).append(i)
+    groups = list(groups.values())
+    if canonicalizer or store.aliases:
+        Log(f"URL 归一化: {len(allUrls)} 个 URL 归为 {len(groups)} 组")
+
+    # 频道状态：未出结果的候选组数、已测速候选、有新结果时的通知；
+    # 调度用：在测的组数、可用选项数、是否已决定，以及按优先顺序排列的待派发组
+    chStates = {}
+    chQueues = {}
+    groupChannels = []
+    for g, members in enumerate(groups):
+        chIds = {chId for i in members for chId, _ in store.Members(i)}
+        groupChannels.append(chIds)
+        for chId in chIds:
+            state = chStates.get(chId)
+            if state is None:
+                state = chStates[chId] = {"pending": 0, "scored": [], "event": asyncio.Event(),
+                                          "inflight": 0, "options": 0, "done": False}
+                chQueues[chId] = deque()
+            state["pending"] += 1
+            chQueues[chId].append(g)
+
+    # 调度堆：(优先级, chId)，优先级变化时压入新项，取出时丢弃过期项
+    dispatched = bytearray(len(groups))
+    heap = []
+    expired = False  # 总预算用完
+
+    def priority(chId):
+        """可用选项少的频道优先，同样多时候选总数少的优先"""
+        state = chStates[chId]
+        return (state["inflight"] + state["options"], state["total"])
+
+    def reschedule(chId):
+        heapq.heappush(heap, (priority(chId), chId))
+
+    def nextGroup():
+        """取出下一个要测的组，没有可派发的组时返回 None"""
+        while heap:
+            key, chId = heap[0]
+            if chStates[chId]["done"] or key != priority(chId):
+                heapq.heappop(heap)
+                continue
+            queue = chQueues[chId]
+            while queue and dispatched[queue[0]]:
+                queue.popleft()
+            if not queue:
+                heapq.heappop(heap)
+                continue
+            g = queue.popleft()
+            dispatched[g] = 1
+            for c in groupChannels[g]:
+                chStates[c]["inflight"] += 1
+                reschedule(c)
+            return g
+        return None
 
-    # 第二步：连通+测速（下载分片验证连通性，同时测速）
-    Log(f"--- 连通测速 ---")
+    for chId, state in chStates.items():
+        state["total"] = state["pending"]
+        reschedule(chId)
 
-    async def connectAndTest(url):
-        """下载分片验证连通性，同时返回测速数据"""
-        async with sem:
-            return await TestUrl(url, timeout)
+    def abandoned(g):
+        """已派发但所属频道在排队期间全部决定的组不再测试，计入调度跳过"""
+        if stopWhenDecided and all(chStates[c]["done"] for c in groupChannels[g]):
+            dispatched[g] = 0
+            return True
+        return False
 
-    tasks = [connectAndTest(url) for url in quickUrls]
-    results = await asyncio.gather(*tasks)
+    quickPassed = 0
+    testPassed = 0
+    fallbacks = 0
 
-    urlScores = {}
-    for url, result in zip(quickUrls, results):
+    def resolveGroup(g, i, result):
+        """组测试结束（某个成员通过或全部失败），通知组内所有成员所属的频道，通过的成员代表整组"""
+        nonlocal testPassed
         if result:
-            urlScores[url] = {"ttfb": result["ttfb"], "speed": result["speed"]}
-
-    Log(f"通过: {len(urlScores)}/{len(quickUrls)}")
-
-    if not urlScores:
-        Log("没有可连接的源")
-        return {}
+            testPassed += 1
+        for chId in groupChannels[g]:
+            state = chStates[chId]
+            state["pending"] -= 1
+            state["inflight"] -= 1
+            if result:
+                state["scored"].append((result["ttfb"], store.urls[i]))
+                state["options"] += 1
+            reschedule(chId)
+            state["event"].set()
+
+    def failUrl(i):
+        store.SetTest(i, None)
+        if history:
+            history.Record(store.urls[i], False)
+
+    async def quickProbe(g, pos):
+        """从组内第 pos 个成员开始快速测试（m3u8 有内容），返回第一个通过的成员位置，全部失败返回 None"""
+        nonlocal fallbacks
+        members = groups[g]
+        for k in range(pos, len(members)):
+            if expired:
+                return None
+            if k > 0:
+                fallbacks += 1
+            async with sem:
+                with Metrics.Track("quick"):
+                    content = await AioFetch(client, store.urls[members[k]], timeout=5)
+            if content is not None and ("#EXTINF" in content or "#EXT-X-STREAM-INF" in content):
+                return k
+            failUrl(members[k])
+        return None
 
-    # 第三步：所有频道并行深度验证（优先 1080p）
-    Log(f"--- 深度验证 ---")
+    quickQueue = asyncio.Queue(maxsize=quickWorkers * 2)
+    testQueue = asyncio.Queue(maxsize=testWorkers * 2)
+
+    async def closeQueue(queue, count):
+        """放入 count 个结束标记。总预算用完时先清空队列（排队未测的组计入调度跳过），
+        不等待可能已被取消的下游 worker；即使某个调用吞掉了取消，worker 也能按标记或 expired 退出"""
+        nonlocal quickPassed
+        if not expired:
+            for _ in range(count):
+                await queue.put(None)
+            return
+        while not queue.empty():
+            item = queue.get_nowait()
+            if isinstance(item, tuple):
+                quickPassed -= 1
+                item = item[0]
+            if item is not None:
+                dispatched[item] = 0
+        for _ in range(count):
+            queue.put_nowait(None)
+
+    async def produce():
+        try:
+            while not expired:
+                g = nextGroup()
+                if g is None:
+                    break
+                await quickQueue.put(g)
+        finally:
+            await closeQueue(quickQueue, quickWorkers)
+
+    # 第一步：快速测试
+    async def quickWorker():
+        nonlocal quickPassed
+        while not expired:
+            g = await quickQueue.get()
+            if g is None:
+                return
+            if abandoned(g):
+                continue
+            pos = await quickProbe(g, 0)
+            if expired:
+                # 测完时预算已用完，不再送入连通测速
+                dispatched[g] = 0
+                return
+            if pos is not None:
+                quickPassed += 1
+                await testQueue.put((g, pos))
+            else:
+                resolveGroup(g, None, None)
 
+    async def quickStage():
+        try:
+            await asyncio.gather(*(quickWorker() for _ in range(quickWorkers)))
+        finally:
+            await closeQueue(testQueue, testWorkers)
+
+    # 第二步：连通+测速（下载分片验证连通性，同时测速）；失败时在本 worker 内回退到组内下一个成员
+    async def testWorker():
+        nonlocal quickPassed
+        while not expired:
+            item = await testQueue.get()
+            if item is None:
+                return
+            g, pos = item
+            if abandoned(g):
+                quickPassed -= 1
+                continue
+            result = None
+            while pos is not None and not expired:
+                i = groups[g][pos]
+                url = store.urls[i]
+                async with sem:
+                    with Metrics.Track("test"):
+                        result = await TestUrl(client, url, timeout)
+                if result:
+                    break
+                failUrl(i)
+                pos = await quickProbe(g, pos + 1)
+            if expired and not result:
+                # 预算用完时未测完的组计入调度跳过
+                dispatched[g] = 0
+                quickPassed -= 1
+                return
+            if result:
+                Metrics.Observe("ttfb", result["ttfb"])
+                Metrics.Observe("speed", result["speed"])
+                store.SetTest(i, result)
+                if history:
+                    history.Record(url, True, ttfb=result["ttfb"], speed=result["speed"], speedStd=result["speedStd"])
+            resolveGroup(g, i, result)
+
+    # 第三步：各频道深度验证（优先 1080p）
     audioOnlyCount = 0  # 统计纯音频源数量
+    staleCount = 0  # 播放列表停更
+    slowCount = 0  # 卡顿风险超限
+
+    async def deepOne(url):
+        async with deepSem:
+            with Metrics.Track("deep"):
+                return await DeepVerify(client, url, timeout=10)
+
+    async def liveOne(url):
+        # 大部分时间在等待播放列表更新，不占深度验证并发
+        # LiveCheck 自己控制窗口截止时间，这里只兜底；超时说明结果未知，不按高风险淘汰
+        with Metrics.Track("live"):
+            try:
+                return await asyncio.wait_for(LiveCheck(client, url, liveWindow), liveWindow + LiveCheckSlack)
+            except asyncio.TimeoutError:
+                return {"fresh": None, "realtime": None, "risk": None}
+
+    async def verifyOne(url):
+        """返回 (是否通过, 分辨率, 直播检查结果)"""
+        if not liveWindow:
+            return (*await deepOne(url), None)
+        (passed, resolution), live = await asyncio.gather(deepOne(url), liveOne(url))
+        return passed, resolution, live
 
     async def verifyChannel(chId):
-        """单频道验证：按延迟排序，优先 1080p，延迟超限用备选"""
-        nonlocal audioOnlyCount
-        candidates = []
-        for url, src in chDict.get(chId, []):
-            if url in urlScores:
-                data = urlScores[url]
-                candidates.append((data["ttfb"], url))
-
-        if not candidates:
+        """单频道验证：候选测速结果陆续到达，按延迟顺序同时验证前 raceK 个，优先 1080p，延迟超限用备选
+        - 延迟不超过阈值的 1080p 通过即返回，取消其余验证
+        - 已有通过的候选（备选）后，不再启动延迟超过阈值的候选
+        - 最终取通过候选中延迟最低的（与逐个验证的结果一致）
+        - 超过 channelBudget 秒未决定时，取消剩余验证，返回已有最优结果
+        """
+        nonlocal audioOnlyCount, staleCount, slowCount
+        state = chStates.get(chId)
+        if not state:
             return None
 
-        # 按延迟升序排序
-        candidates.sort(key=lambda x: x[0])
+        # 等待足够的候选测完
+        while state["pending"] > 0 and not expired and len(state["scored"]) < minReady:
+            state["event"].clear()
+            await state["event"].wait()
 
-        backup = None
+        deadlines = [t for t in (time.time() + channelBudget if channelBudget else None,
+                                 startTime + budget if budget else None) if t]
+        deadline = min(deadlines) if deadlines else None
+        tried = set()
+        inflight = {}  # task -> (ttfb, url)
+        passedList = []  # [(ttfb, url, resolution)]
+        info = decisions[chId] = {"tried": 0, "timedOut": False, "passed": passedList, "failed": set(), "risk": {}}
 
-        for ttfb, url in candidates:
-            # 延迟超过阈值且有备选，停止找 1080p
-            if ttfb > hdLatencyLimit and backup:
-                break
+        try:
+            while True:
+                state["event"].clear()
+                candidates = sorted(c for c in state["scored"] if c[1] not in tried)
+                # 已有备选，不再用延迟超限的候选找 1080p
+                if passedList:
+                    candidates = [c for c in candidates if c[0] <= hdLatencyLimit]
+                # 总预算用完后不再启动新的验证
+                for ttfb, url in candidates[:max(0, raceK - len(inflight))] if not expired else ():
+                    tried.add(url)
+                    inflight[asyncio.ensure_future(verifyOne(url))] = (ttfb, url)
+                info["tried"] = len(tried)
+
+                waiters = set(inflight)
+                eventTask = None
+                if state["pending"] > 0 and not expired and len(inflight) < raceK:
+                    eventTask = asyncio.ensure_future(state["event"].wait())
+                    waiters.add(eventTask)
+                if not waiters:
+                    break
+
+                remaining = deadline - time.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    done = set()
+                else:
+                    done, _ = await asyncio.wait(waiters, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                if eventTask and not eventTask.done():
+                    eventTask.cancel()
+                if not done:
+                    info["timedOut"] = True
+                    break
+
+                for task in done:
+                    if task is eventTask:
+                        continue
+                    ttfb, url = inflight.pop(task)
+                    passed, resolution, live = task.result()
+                    if live and live["risk"] is not None:
+                        info["risk"][url] = live["risk"]
+                    if passed and live:
+                        if live["fresh"] is False:
+                            passed = False
+                            staleCount += 1
+                        elif live["risk"] is not None and live["risk"] > maxRisk:
+                            passed = False
+                            slowCount += 1
+                    if history:
+                        history.Record(url, passed, resolution=resolution if passed else None, audioOnly=resolution == -1)
+                    store.SetVerify(store.index[url], passed, resolution, live)
+                    if not passed:
+                        info["failed"].add(url)
+                        # 验证淘汰的候选不再算可用选项，频道重新获得调度优先级
+                        state["options"] -= 1
+                        reschedule(chId)
+                    if passed:
+                        passedList.append((ttfb, url, resolution))
+                        if resolution >= 1080 and ttfb <= hdLatencyLimit:
+                            return (chId, url, resolution)
+                    elif resolution == -1:
+                        # 纯音频源，统计但不使用
+                        audioOnlyCount += 1
+
+                # 延迟最低的通过候选是 1080p，且没有更低延迟的验证在进行，直接采用
+                if passedList:
+                    ttfb, url, resolution = min(passedList)
+                    if resolution >= 1080 and all(t >= ttfb for t, _ in inflight.values()):
+                        return (chId, url, resolution)
+        finally:
+            for task in inflight:
+                task.cancel()
 
-            passed, resolution = await DeepVerify(url, timeout=10)
-            if passed:
-                if resolution >= 1080:
-                    return (chId, url, resolution)
-                elif backup is None:
-                    backup = (chId, url, resolution)
-            elif resolution == -1:
-                # 纯音频源，统计但不使用
-                audioOnlyCount += 1
-
-        return backup
-
-    # 所有频道并行验证
-    tasks = [verifyChannel(chId) for chId in Channels]
-    results = await asyncio.gather(*tasks)
+        if not passedList:
+            return None
+        ttfb, url, resolution = min(passedList)
+        return (chId, url, resolution)
+
+    async def decideChannel(chId):
+        """验证单频道并记录决策耗时，已决定的频道不再派发新的候选"""
+        result = await verifyChannel(chId)
+        if stopWhenDecided and chId in chStates:
+            chStates[chId]["done"] = True
+        if chId in decisions:
+            info = decisions[chId]
+            label = (f"{result[2]}p" if result[2] > 0 else "未知") if result else "无可用源"
+            suffix = "，超出预算" if info["timedOut"] else ""
+            Log(f"  {chId}: {label}，{time.time() - startTime:.1f}s 决定，验证 {info['tried']} 个{suffix}")
+        return result
+
+    decisions = {}
+
+    def expire():
+        """总预算用完：置 expired 标记并取消流水线 worker，正在等待候选的频道立即用已有结果
+        各 worker 和生产者都检查 expired，不依赖每个被等待的调用都把取消传递出来"""
+        nonlocal expired
+        expired = True
+        Log(f"选源总预算 {budget}s 用完，停止测速，按已有结果选源")
+        for task in workers:
+            task.cancel()
+        for state in chStates.values():
+            state["event"].set()
+
+    # 所有阶段和所有频道同时运行
+    workers = [asyncio.ensure_future(c) for c in (produce(), quickStage(), *(testWorker() for _ in range(testWorkers)))]
+    pipeline = asyncio.gather(*workers, return_exceptions=True)
+    timer = asyncio.get_running_loop().call_later(budget, expire) if budget else None
+    decided = await asyncio.gather(*(decideChannel(chId) for chId in Channels))
+    # 总预算用完时 worker 被取消，其余异常照常抛出
+    for r in await pipeline:
+        if isinstance(r, Exception):
+            raise r
+    if timer:
+        timer.cancel()
+
+    skippedGroups = len(groups) - sum(dispatched)
+    Log(f"快速测试通过: {quickPassed}/{len(groups) - skippedGroups}")
+    Log(f"连通测速通过: {testPassed}/{quickPassed}")
+    if fallbacks:
+        Log(f"等价 URL 回退: {fallbacks} 次")
+    if skippedGroups:
+        Log(f"调度跳过: {skippedGroups} 组候选未测（{'总预算用完' if expired else '所属频道均已决定'}）")
+    Metrics.Set("urls", len(allUrls))
+    Metrics.Set("skippedGroups", skippedGroups)
+    Metrics.Set("budgetExpired", int(expired))
+    Metrics.Set("probeGroups", len(groups))
+    Metrics.Set("fallbacks", fallbacks)
+    Metrics.Set("quickPassed", quickPassed)
+    Metrics.Set("testPassed", testPassed)
+    Log(f"流水线耗时: {time.time() - startTime:.1f}s")
 
     best = {}
     bestResolutions = {}
-    for r in results:
+    for r in decided:
         if r:
             chId, url, resolution = r
             best[chId] = url
             bestResolutions[chId] = resolution
 
+    if ranking is not None:
+        for chId, info in decisions.items():
+            urls = [best[chId]] if chId in best else []
+            # 验证通过的按卡顿风险（0.1 一档）再按延迟排序
+            passedSorted = sorted(info["passed"], key=lambda c: (round(info["risk"].get(c[1], 0), 1), c[0]))
+            urls += [url for _, url, _ in passedSorted if url not in urls]
+            urls += [url for _, url in sorted(chStates[chId]["scored"]) if url not in urls and url not in info["failed"]]
+            ranking[chId] = urls
+
     # 输出统计
     if audioOnlyCount > 0:
         Log(f"过滤纯音频源: {audioOnlyCount} 个")
+    if staleCount or slowCount:
+        Log(f"直播检查淘汰: 停更 {staleCount} 个，卡顿风险超限 {slowCount} 个")
 
     resStats = {}
     for chId, res in bestResolutions.items():
@@ -581,41 +2744,183 @@ async def SelectBestSources(chDict, timeout=30, maxConcur=100, hdLatencyLimit=2)
         resStats[label] = resStats.get(label, 0) + 1
     resInfo = ", ".join(f"{k}:{v}" for k, v in sorted(resStats.items(), reverse=True))
     Log(f"选出最优源: {len(best)}/{len(Channels)} 个频道 ({resInfo})")
+    Metrics.Set("channels", len(best))
+    Metrics.Set("audioOnly", audioOnlyCount)
+    Metrics.Set("resolutions", resStats)
 
     return best
 
 
-def LoadExistingM3U(filename):
-    """读取现有的 m3u 文件，返回 {chId: url}"""
+# ==================== 分片测速 ====================
+
+# 分片结果目录
+ShardDir = RootDir / "Shards"
+
+
+def ShardOf(url, count):
+    """按 URL 的稳定哈希分片，各进程、各机器结果一致"""
+    return int(hashlib.sha1(url.encode("utf-8")).hexdigest()[:8], 16) % count
+
+
+def FilterShard(store, index, count):
+    """只保留属于第 index 个分片（共 count 片）的 URL"""
+    return store.Rebuild(lambda chId, url: url if ShardOf(url, count) == index else None)
+
+
+def WriteShardResults(path, region, index, count, store):
+    """写入分片结果文件（只含已测的 URL）
+    entries: [url, [chId, ...], ttfb, speed, verified, resolution]，测试失败时 ttfb/speed 为 null，
+    verified 为 1/0，未深度验证为 null
+    """
+    entries = []
+    for i, url in enumerate(store.urls):
+        status = store.status[i] if store.status else store.Untested
+        if status == store.Untested:
+            continue
+        chIds = [chId for chId, _ in store.Members(i)]
+        if status == store.Passed:
+            verified = store.verified[i]
+            entries.append([url, chIds, round(store.ttfb[i], 4), round(store.speed[i]),
+                            None if verified < 0 else verified, store.resolution[i]])
+        else:
+            entries.append([url, chIds, None, None, 0, 0])
+    data = {"version": 1, "region": region, "shard": [index, count],
+            "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "entries": entries}
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+    tmp.replace(path)
+    Log(f"分片结果: {path} ({len(entries)} 个 URL)")
+
+
+def MergeResults(files, weights=None, hdLatencyLimit=2):
+    """合并分片/区域结果并为每个频道选源，返回 {chId: url}
+    同一 URL 出现在多个区域时按区域权重加权：延迟取加权平均，验证通过权重多于失败权重才算通过，
+    测试失败（不可达）计入失败权重；选源规则与 SelectBestSources 一致：
+    延迟不超过阈值的 1080p 中取延迟最低的，没有则取通过候选中延迟最低的
+    """
+    weights = weights or {}
+    merged = {}  # url -> 累计值
+    regions = {}
+    for file in files:
+        try:
+            data = json.loads(Path(file).read_text(encoding="utf-8"))
+        except:
+            Log(f"跳过无法读取的结果文件: {file}")
+            continue
+        region = data.get("region", "")
+        weight = weights.get(region, 1.0)
+        regions[region] = regions.get(region, 0) + 1
+        for url, chIds, ttfb, speed, verified, resolution in data.get("entries", []):
+            m = merged.setdefault(url, {"chIds": set(), "w": 0.0, "ttfb": 0.0, "speed": 0.0,
+                                        "passW": 0.0, "failW": 0.0, "resolution": 0})
+            m["chIds"].update(chIds)
+            if ttfb is None:
+                m["failW"] += weight
+                continue
+            m["w"] += weight
+            m["ttfb"] += ttfb * weight
+            m["speed"] += speed * weight
+            if verified == 1:
+                m["passW"] += weight
+                m["resolution"] = max(m["resolution"], resolution)
+            elif verified == 0:
+                m["failW"] += weight
+
+    regionInfo = ", ".join(f"{r or '默认'}({n})" for r, n in regions.items())
+    Log(f"合并结果: {len(files)} 个文件，{len(merged)} 个 URL，区域 {regionInfo}")
+
+    candidates = {}  # chId -> [(ttfb, url, resolution)]
+    for url, m in merged.items():
+        if m["passW"] <= m["failW"] or not m["w"]:
+            continue
+        ttfb = m["ttfb"] / m["w"]
+        for chId in m["chIds"]:
+            candidates.setdefault(chId, []).append((ttfb, url, m["resolution"]))
+
+    best = {}
+    resStats = {}
+    for chId in Channels:
+        passed = sorted(candidates.get(chId, []))
+        if not passed:
+            continue
+        hd = [c for c in passed if c[2] >= 1080 and c[0] <= hdLatencyLimit]
+        ttfb, url, resolution = hd[0] if hd else passed[0]
+        best[chId] = url
+        label = f"{resolution}p" if resolution > 0 else "未知"
+        resStats[label] = resStats.get(label, 0) + 1
+    resInfo = ", ".join(f"{k}:{v}" for k, v in sorted(resStats.items(), reverse=True))
+    Log(f"选出最优源: {len(best)}/{len(Channels)} 个频道 ({resInfo})")
+    return best
+
+
+def RunMerge(files, weights=None, publish=True):
+    """合并命令：读取配置中的频道表和区域权重，合并结果后生成 iptv.m3u"""
+    cfg = LoadConfig()
+    if not cfg or not LoadChannels(cfg):
+        return
+    settings = cfg.get("设置", {})
+    allWeights = dict(settings.get("区域权重", {}))
+    allWeights.update(weights or {})
+    best = MergeResults(files, allWeights, settings.get("高清延迟阈值毫秒", 2000) / 1000)
+    if not best:
+        Log("合并结果为空，跳过生成")
+        return
+    if publish:
+        PublishM3U(best)
+    else:
+        GenerateM3U(best, "iptv.m3u")
+        Log(f"生成完成: iptv.m3u ({len(best)} 个频道)，未提交")
+
+
+def LoadExistingM3U(filename, multi=False):
+    """读取现有的 m3u 文件，返回 {chId: url}；multi=True 时返回 {chId: [url, ...]}（按文件顺序，用于多源备选列表）"""
     path = RootDir / filename
     if not path.exists():
         return {}
 
     existing = {}
-    content = path.read_text(encoding="utf-8")
-    lines = content.strip().split("\n")
-    i = 0
-    while i < len(lines):
-        line = lines[i].strip()
-        if line.startswith("#EXTINF:"):
-            # 匹配频道名
-            match = re.search(r',(.+)$', line)
-            if match and i + 1 < len(lines):
-                name = match.group(1).strip()
-                url = lines[i + 1].strip()
-                # 从频道名匹配 chId
-                chId = MatchChannel(name)
-                if chId and url and not url.startswith("#"):
-                    existing[chId] = url
-                i += 1
-        i += 1
+    for item in ParseM3U(path.read_text(encoding="utf-8")):
+        # 从频道名匹配 chId
+        chId = MatchChannel(item["name"])
+        if chId:
+            if multi:
+                existing.setdefault(chId, []).append(item["url"])
+            else:
+                existing[chId] = item["url"]
     return existing
 
 
+def SameChannelUrls(filename, sources):
+    """sources 合并进现有 m3u 文件后，各频道的地址集合是否与文件中相同（只是排序变化不算）"""
+    if not (RootDir / filename).exists():
+        return False
+    old = {chId: set(urls) for chId, urls in LoadExistingM3U(filename, multi=True).items()}
+    new = dict(old)
+    for chId, urls in sources.items():
+        if chId in Channels:
+            new[chId] = {urls} if isinstance(urls, str) else set(urls)
+    return new == old
+
+
+def BuildM3U(sources):
+    """按频道表顺序生成 m3u 内容，sources: {chId: url 或 [url, ...]}，多个 URL 时同一频道输出多条"""
+    lines = ['#EXTM3U x-tvg-url="https://epg.112114.xyz/pp.xml"']
+    for chId in Channels:
+        if chId in sources:
+            info = Channels[chId]
+            urls = sources[chId]
+            for url in [urls] if isinstance(urls, str) else urls:
+                lines.append(f'#EXTINF:-1 tvg-name="{info["tvg_name"]}" tvg-logo="{info["logo"]}" group-title="{info["group"]}",{info["name"]}')
+                lines.append(url)
+    return "\n".join(lines) + "\n"
+
+
 def GenerateM3U(sources, filename):
-    """生成 m3u 文件，保留旧源（新源未覆盖的频道）"""
+    """生成 m3u 文件，保留旧源（新源未覆盖的频道，多源备选列表保留该频道的全部地址和顺序）"""
     # 读取现有源
-    existing = LoadExistingM3U(filename)
+    existing = LoadExistingM3U(filename, multi=True)
     preserved = 0
 
     # 合并：新源优先，无新源则保留旧源
@@ -624,7 +2929,8 @@ def GenerateM3U(sources, filename):
         if chId in sources:
             merged[chId] = sources[chId]
         elif chId in existing:
-            merged[chId] = existing[chId]
+            urls = existing[chId]
+            merged[chId] = urls[0] if len(urls) == 1 else urls
             preserved += 1
 
     if not merged:
@@ -634,14 +2940,7 @@ def GenerateM3U(sources, filename):
     if preserved > 0:
         Log(f"保留旧源: {preserved} 个频道")
 
-    lines = ['#EXTM3U x-tvg-url="https://epg.112114.xyz/pp.xml"']
-    for chId in Channels:
-        if chId in merged:
-            info = Channels[chId]
-            lines.append(f'#EXTINF:-1 tvg-name="{info["tvg_name"]}" tvg-logo="{info["logo"]}" group-title="央视频道",{info["name"]}')
-            lines.append(merged[chId])
-
-    content = "\n".join(lines) + "\n"
+    content = BuildM3U(merged)
     path = RootDir / filename
 
     if path.exists() and path.read_text(encoding="utf-8") == content:
@@ -650,97 +2949,805 @@ def GenerateM3U(sources, filename):
     return True
 
 
-def HasChanges():
-    """检查 iptv.m3u 是否有变化"""
+def HasChanges(files=("iptv.m3u",)):
+    """检查输出文件（默认 iptv.m3u）是否有变化"""
     diff = subprocess.run(
-        ["git", "diff", "--name-only", "iptv.m3u"],
+        ["git", "diff", "--name-only", *files],
         capture_output=True, text=True, cwd=RootDir
     )
     untracked = subprocess.run(
-        ["git", "ls-files", "--others", "--exclude-standard", "iptv.m3u"],
+        ["git", "ls-files", "--others", "--exclude-standard", *files],
         capture_output=True, text=True, cwd=RootDir
     )
     return bool(diff.stdout.strip() or untracked.stdout.strip())
 
 
-def CommitAndPush():
-    """提交并推送 iptv.m3u"""
+def CommitAndPush(files=("iptv.m3u",)):
+    """提交并推送输出文件（默认 iptv.m3u）"""
     now = datetime.now().strftime("%Y-%m-%d %H:%M")
     msg = f"update: {now}"
-    subprocess.run(["git", "add", "iptv.m3u"], cwd=RootDir)
+    subprocess.run(["git", "add", *files], cwd=RootDir)
     subprocess.run(["git", "commit", "-m", msg], cwd=RootDir)
     subprocess.run(["git", "push"], cwd=RootDir)
     Log(f"已推送: {msg}")
 
 
-async def RunOnce():
-    """执行一次抓取测速流程"""
-    Log(f"=== LiteIPTV 开始: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ===")
+def ApplySettings(settings):
+    """读取模块级参数（ffprobe 并发、测速预算）"""
+    global FfprobeSem, MeasureBytes, MeasureSeconds, VerifyBytes, VariantMargin
+    FfprobeSem = asyncio.Semaphore(settings.get("ffprobe并发数", 4))
+    MeasureBytes = settings.get("测速字节预算KB", 1024) * 1024
+    MeasureSeconds = settings.get("测速时间预算秒", 5)
+    VerifyBytes = settings.get("验证读取KB", 256) * 1024
+    VariantMargin = settings.get("变体带宽余量", 1.2)
 
-    cfg = LoadConfig()
-    if not cfg:
-        return
 
-    # 读取配置
+def SelectOptions(settings):
+    """读取 SelectBestSources 的测速参数"""
+    maxConcur = settings.get("最大并发数", 500)
+    return {
+        "timeout": settings.get("测速超时秒", 30),
+        "maxConcur": maxConcur,
+        "hdLatencyLimit": settings.get("高清延迟阈值毫秒", 2000) / 1000,  # 转换为秒
+        "maxFails": settings.get("跳过连续失败次数", 3),
+        "retryAfter": settings.get("失败重测间隔小时", 6) * 3600,
+        "stageConcur": {
+            "quick": settings.get("快速测试并发数", maxConcur),
+            "test": settings.get("连通测速并发数", maxConcur),
+            "deep": settings.get("深度验证并发数", 32),
+        },
+        "minReady": settings.get("深度验证启动候选数", 3),
+        "raceK": settings.get("深度验证竞速数", 3),
+        "channelBudget": settings.get("频道验证预算秒", 120),
+        "liveWindow": settings.get("直播检查秒", 8),
+        "maxRisk": settings.get("卡顿风险上限", 0.5),
+        "canonicalizer": UrlCanonicalizer(settings.get("URL等价规则")) if settings.get("启用URL归一化", True) else None,
+        "budget": settings.get("选源总预算秒", 600),
+        # 开启时排名、备选和快速输出只含决定前测过的少数候选，默认关闭
+        "stopWhenDecided": settings.get("频道决定后停止测速", False),
+    }
+
+
+def OpenHistory(settings):
+    """按配置打开历史质量库，未启用时返回 None"""
+    if not settings.get("启用历史库", True):
+        return None
+    return HistoryStore(halfLife=settings.get("历史半衰期小时", 24) * 3600)
+
+
+def CreateClient(settings):
+    """按配置创建共享 HTTP 客户端（连接池、运行缓存、主机并发）"""
+    cacheMB = settings.get("运行缓存上限MB", 64)
+    cacheTtl = settings.get("运行缓存有效期秒", 30)
+    hostInitial = settings.get("单主机初始并发", 8)
+    hostMax = settings.get("单主机最大并发", 64)
+    breakerThreshold = settings.get("熔断连续失败次数", 5)
+    runCache = RunCache(cacheMB * 1024 * 1024, cacheTtl) if cacheMB > 0 else None
+    hostLimiter = HostLimiter(hostInitial, hostMax) if hostInitial > 0 else None
+    breaker = None
+    if breakerThreshold > 0:
+        breaker = HostBreaker(breakerThreshold, settings.get("熔断冷却秒", 30), settings.get("熔断最长冷却秒", 600))
+        if settings.get("熔断状态持久化", False):
+            breaker.Load(BreakerStateFile)
+    return HttpClient(
+        settings.get("连接池上限", 1000),
+        settings.get("单主机连接上限", 0),
+        settings.get("连接保活秒", 30),
+        runCache, hostLimiter, HostResolver(settings.get("DNS缓存秒", 300)), breaker
+    )
+
+
+def ConfigureClient(client, settings):
+    """配置热加载：按新配置更新已有客户端的主机并发和熔断参数，已有的主机状态保留
+    （连接池上限、单主机连接上限、连接保活秒需重启生效）"""
+    hostInitial = settings.get("单主机初始并发", 8)
+    if hostInitial <= 0:
+        client.hostLimiter = None
+    elif client.hostLimiter:
+        client.hostLimiter.initial = hostInitial
+        client.hostLimiter.maxLimit = settings.get("单主机最大并发", 64)
+    else:
+        client.hostLimiter = HostLimiter(hostInitial, settings.get("单主机最大并发", 64))
+    breakerThreshold = settings.get("熔断连续失败次数", 5)
+    if breakerThreshold <= 0:
+        client.breaker = None
+    elif client.breaker:
+        client.breaker.threshold = breakerThreshold
+        client.breaker.cooldown = settings.get("熔断冷却秒", 30)
+        client.breaker.maxCooldown = settings.get("熔断最长冷却秒", 600)
+    else:
+        client.breaker = HostBreaker(breakerThreshold, settings.get("熔断冷却秒", 30), settings.get("熔断最长冷却秒", 600))
+
+
+def SaveBreakerState(client, settings):
+    """熔断状态持久化 开启时保存熔断中的主机，下次运行冷却期内直接跳过"""
+    if client.breaker and settings.get("熔断状态持久化", False):
+        client.breaker.Save(BreakerStateFile)
+
+
+async def CollectSources(client, cfg, cache=None):
+    """抓取上游源并筛选频道，合并散装源，返回 CandidateStore"""
     settings = cfg.get("设置", {})
     maxRetry = settings.get("抓取重试次数", 3)
     retryDelay = settings.get("抓取重试间隔秒", 3)
-    timeout = settings.get("测速超时秒", 30)
-    maxConcur = settings.get("最大并发数", 500)
-    hdLatencyLimit = settings.get("高清延迟阈值毫秒", 2000) / 1000  # 转换为秒
 
     # 并行抓取所有上游源
     Log("--- 抓取上游源 ---")
-    allItems = await FetchAllSources(cfg.get("上游源", []), maxRetry, retryDelay)
-    Log(f"共抓取 {len(allItems)} 个频道")
-
-    # 筛选 CCTV 频道（过滤黑名单和 IPv6）
+    # 边下载边筛选 CCTV 频道（过滤黑名单和 IPv6）
     blacklist = cfg.get("黑名单", [])
-    chDict = FilterChannels(allItems, blacklist)
+    store = await FetchAllSources(client, cfg.get("上游源", []), maxRetry, retryDelay, cache, blacklist)
 
     # 合并散装源
     customSources = cfg.get("散装源", {})
     customCount = 0
     for chId, urls in customSources.items():
-        if chId in chDict and urls:
+        if chId in Channels and urls:
             for url in urls:
-                chDict[chId].append((url, "自定义"))
+                store.Add(chId, url, "自定义")
                 customCount += 1
     if customCount > 0:
         Log(f"添加散装源: {customCount} 个")
 
-    totalUrls = sum(len(urls) for urls in chDict.values())
-    uniqueUrls = len(set(url for urls in chDict.values() for url, _ in urls))
-    Log(f"筛选出 CCTV 频道: {totalUrls} 个源 ({uniqueUrls} 个唯一)")
-
-    best = await SelectBestSources(chDict, timeout, maxConcur, hdLatencyLimit)
-
-    # 生成 m3u 文件
+    Log(f"筛选出 CCTV 频道: {store.Entries()} 个源 ({len(store)} 个唯一)")
+
+    # 预解析 DNS：过滤无 IPv4 地址的源，合并指向同一服务器的镜像
+    if settings.get("DNS预解析", True):
+        store = await DedupeByAddress(client, store, settings.get("DNS解析并发数", 64))
+    return store
+
+
+def WriteRunReport(settings):
+    """按配置写入运行报告（JSON）和 Prometheus 文本文件，并输出各阶段耗时"""
+    report = Metrics.WriteReport(settings.get("运行报告文件", "run-report.json"), settings.get("Prometheus文件", ""))
+    parts = [f"{name} {st['wall']}s ({st['calls']} 次，平均 {st['mean']}s)" for name, st in report["stages"].items()]
+    Log(f"阶段耗时: {', '.join(parts)}")
+    errors = {}
+    for outcomes in report["requests"].values():
+        for outcome, count in outcomes.items():
+            if outcome != "ok":
+                errors[outcome] = errors.get(outcome, 0) + count
+    if errors:
+        Log(f"请求失败: {', '.join(f'{k} {v}' for k, v in sorted(errors.items()))}")
+
+
+def VariantSources(sources, variants):
+    """把 {chId: url 或 [url, ...]} 中的 Master 地址替换为测速选中的变体地址（variants 为 client.variants）"""
+    def pick(url):
+        chosen = variants.get(url)
+        return chosen[0] if chosen else url
+    return {chId: pick(urls) if isinstance(urls, str) else [pick(u) for u in urls] for chId, urls in sources.items()}
+
+
+def RankOutputs(best, ranking, store, backups=3, fastHeight=720, variants=None):
+    """由一次测速的排名生成多级输出（不再发起请求），返回 (备选 {chId: [url...]}, 快速 {chId: url}, 排名 JSON)
+    - 备选：每个频道按排名取前 backups 个
+    - 快速：深度验证通过且不低于 fastHeight 的候选中 TTFB 最低的，没有则用最优源
+    - 排名 JSON 中 Master 地址附带选中的变体地址（variant），备选和快速输出使用变体地址
+    """
+    variants = variants or {}
+    backupSources = {}
+    fastSources = {}
+    rankingData = {}
+    for chId in Channels:
+        urls = ranking.get(chId) or ([best[chId]] if chId in best else [])
+        if not urls:
+            continue
+        backupSources[chId] = urls[:backups]
+
+        entries = []
+        for url in urls:
+            r = store.Result(url) or {}
+            live = r.get("live") or {}
+            entries.append({"url": url, "ttfb": round(r.get("ttfb", 0), 3), "speed": round(r.get("speed", 0)),
+                            "verified": r.get("verified"), "resolution": r.get("resolution", 0),
+                            "fresh": live.get("fresh"), "realtime": live.get("realtime"), "risk": live.get("risk")})
+            if url in variants:
+                entries[-1]["variant"] = variants[url][0]
+        rankingData[chId] = entries
+
+        fast = [(e["ttfb"], e["url"]) for e in entries if e["verified"] and e["resolution"] >= fastHeight]
+        fastSources[chId] = min(fast)[1] if fast else urls[0]
+    return VariantSources(backupSources, variants), VariantSources(fastSources, variants), rankingData
+
+
+def WriteOutputs(best, ranking, store, settings, merge=False, variants=None):
+    """写入备选播放列表、快速起播播放列表和排名 JSON，返回写入的播放列表文件名（参与变化检测和提交）
+    merge=True 时只更新 best 中的频道，排名 JSON 中其他频道保留原有内容（播放列表由 GenerateM3U 保留旧源）
+    """
+    backupFile = settings.get("备选播放列表", "iptv-backup.m3u")
+    fastFile = settings.get("快速播放列表", "iptv-fast.m3u")
+    rankFile = settings.get("排名文件", "ranking.json")
+    backupSources, fastSources, rankingData = RankOutputs(
+        best, ranking, store, settings.get("备选数", 3), settings.get("快速起播分辨率", 720), variants)
+
+    files = []
+    for filename, sources in ((backupFile, backupSources), (fastFile, fastSources)):
+        if filename and sources:
+            # 只有排名抖动（地址集合不变）时不重写，避免每次运行都提交
+            if SameChannelUrls(filename, sources):
+                Log(f"{filename}: 各频道地址未变，跳过写入")
+                continue
+            GenerateM3U(sources, filename)
+            files.append(filename)
+    if rankFile:
+        if merge:
+            try:
+                old = json.loads((RootDir / rankFile).read_text(encoding="utf-8"))
+            except:
+                old = {}
+            merged = {**old, **rankingData}
+            rankingData = {chId: merged[chId] for chId in Channels if chId in merged}
+        (RootDir / rankFile).write_text(json.dumps(rankingData, ensure_ascii=False, indent=1) + "\n", encoding="utf-8")
+    Log(f"多级输出: {', '.join(files + ([rankFile] if rankFile else [])) or '无'}")
+    return files
+
+
+def PublishM3U(best, extraFiles=()):
+    """生成 iptv.m3u，与 extraFiles 一起检查变化，有变化时提交并推送"""
     GenerateM3U(best, "iptv.m3u")
 
     Log(f"\n生成完成: iptv.m3u ({len(best)} 个频道)")
 
     # 检查变化并提交
-    if HasChanges():
-        CommitAndPush()
+    files = ("iptv.m3u", *extraFiles)
+    if HasChanges(files):
+        CommitAndPush(files)
     else:
         Log("无变化，跳过推送")
 
+
+# 运行状态（距上次全量选源的次数）
+RunStateFile = RootDir / "run-state.json"
+
+
+def LoadRunState():
+    try:
+        return json.loads(RunStateFile.read_text(encoding="utf-8"))
+    except:
+        return {}
+
+
+def SaveRunState(state):
+    RunStateFile.write_text(json.dumps(state, ensure_ascii=False) + "\n", encoding="utf-8")
+
+
+def CurrentUrls(existing, settings, variants=None):
+    """现有源的全部地址 {chId: {url, ...}}：iptv.m3u 中写的是变体地址时，
+    按排名 JSON 中的 url / variant（以及本进程测速选中的变体 variants，即 client.variants）
+    找回对应的 Master 地址（候选池中是 Master 地址）"""
+    current = {chId: {url} for chId, url in existing.items()}
+    if variants:
+        masters = {}
+        for master, (variant, _) in variants.items():
+            masters.setdefault(variant, []).append(master)
+        for chId, urls in current.items():
+            urls.update(masters.get(existing[chId], ()))
+    rankFile = settings.get("排名文件", "ranking.json")
+    try:
+        rankingData = json.loads((RootDir / rankFile).read_text(encoding="utf-8")) if rankFile else {}
+    except:
+        rankingData = {}
+    for chId, urls in current.items():
+        for r in rankingData.get(chId, ()):
+            if existing[chId] in (r.get("url"), r.get("variant")):
+                urls.add(r["url"])
+    return current
+
+
+async def Revalidate(client, existing, settings, history=None):
+    """快速复检：并发测速、深度验证（和直播检查）iptv.m3u 中的现有源，返回未达标的频道列表
+    达标条件：测速延迟不超过 快速复检延迟阈值毫秒，深度验证通过，已知分辨率不低于 快速复检最低分辨率，
+    直播检查序号前进且卡顿风险不超过上限；频道表中没有现有源的频道也算未达标
+    """
+    latencyLimit = settings.get("快速复检延迟阈值毫秒", 3000) / 1000
+    minHeight = settings.get("快速复检最低分辨率", 720)
+    opts = SelectOptions(settings)
+    liveWindow = opts["liveWindow"]
+
+    async def checkOne(chId, url):
+        """返回未达标原因，达标返回 None"""
+        result = await TestUrl(client, url, opts["timeout"])
+        if not result:
+            if history:
+                history.Record(url, False)
+            return "不可达"
+        if history:
+            history.Record(url, True, ttfb=result["ttfb"], speed=result["speed"], speedStd=result["speedStd"])
+        if result["ttfb"] > latencyLimit:
+            return f"延迟 {result['ttfb']:.1f}s 超限"
+
+        tasks = [DeepVerify(client, url)]
+        if liveWindow:
+            tasks.append(asyncio.wait_for(LiveCheck(client, url, liveWindow), liveWindow + LiveCheckSlack))
+        verified, *live = await asyncio.gather(*tasks, return_exceptions=True)
+        if isinstance(verified, BaseException):
+            return "深度验证出错"
+        passed, resolution = verified
+        if history:
+            history.Record(url, passed, resolution=resolution if passed else None, audioOnly=resolution == -1)
+        if not passed:
+            return "纯音频" if resolution == -1 else "深度验证失败"
+        if 0 < resolution < minHeight:
+            return f"分辨率 {resolution}p 低于 {minHeight}p"
+        if live:
+            # 超时说明结果未知，不据此判定未达标
+            live = {"fresh": None, "risk": None} if isinstance(live[0], asyncio.TimeoutError) else live[0]
+            if not isinstance(live, dict):
+                return "直播检查失败"
+            if live["fresh"] is False:
+                return "播放列表停更"
+            if live["risk"] is not None and live["risk"] > opts["maxRisk"]:
+                return f"卡顿风险 {live['risk']:.2f} 超限"
+        return None
+
+    Log(f"--- 快速复检: {len(existing)} 个现有源 ---")
+    start = time.time()
+    chIds = [chId for chId in Channels if chId in existing]
+    reasons = await asyncio.gather(*(checkOne(chId, existing[chId]) for chId in chIds))
+    failed = [chId for chId in Channels if chId not in existing]
+    for chId, reason in zip(chIds, reasons):
+        if reason:
+            failed.append(chId)
+            Log(f"  {chId}: {reason}")
+    Log(f"快速复检: {reasons.count(None)}/{len(chIds)} 个达标 ({time.time() - start:.1f}s)")
+    Metrics.Set("revalidated", len(chIds))
+    Metrics.Set("revalidateFailed", len(failed))
+    return failed
+
+
+async def RunOnce(cfg=None, publish=True, shard=None, region="", resultFile=None, full=False):
+    """执行一次抓取测速流程，返回 {chId: url}
+    cfg: 使用指定配置代替 config.json（基准测试用）；publish=False 时不生成 iptv.m3u、不提交
+    shard: (index, count) 时只测属于该分片的 URL，结果写入 resultFile，不生成 iptv.m3u（由 merge 合并后生成）
+    默认先快速复检 iptv.m3u 现有源：全部达标时直接结束，否则只对未达标频道选源；
+    每 全量刷新间隔次数 次运行（或 full=True）做一次全量选源，持续发现更好的源
+    """
+    Log(f"=== LiteIPTV 开始: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ===")
+
+    cfg = cfg or LoadConfig()
+    if not cfg or not LoadChannels(cfg):
+        return {}
+
+    # 读取配置
+    settings = cfg.get("设置", {})
+    ApplySettings(settings)
+    history = OpenHistory(settings)
+    cache = UpstreamCache() if settings.get("启用上游缓存", True) else None
+
+    global Metrics
+    Metrics = RunMetrics()
+    sampler = asyncio.ensure_future(Metrics.Sample())
+
+    # 快速复检只用于正式运行（生成 iptv.m3u），分片和基准测试总是全量
+    runState = LoadRunState()
+    sinceFull = runState.get("sinceFull", 0)
+    fullEvery = settings.get("全量刷新间隔次数", 6)
+    existing = {}
+    if publish and not shard and not full and settings.get("快速复检", True):
+        if fullEvery and sinceFull + 1 >= fullEvery:
+            Log(f"距上次全量选源已 {sinceFull} 次，本次全量刷新")
+        else:
+            existing = LoadExistingM3U("iptv.m3u")
+
+    # 运行级共享 HTTP 客户端，所有阶段复用连接池
+    async with CreateClient(settings) as client:
+        failed = None
+        if existing:
+            with Metrics.Track("revalidate"):
+                failed = await Revalidate(client, existing, settings, history)
+        ranking = {}
+        store = None
+        if failed == []:
+            Log("现有源全部达标，跳过全量选源")
+            best = dict(existing)
+        else:
+            store = await CollectSources(client, cfg, cache)
+            if shard:
+                index, count = shard
+                store = FilterShard(store, index, count)
+                Log(f"分片 {index}/{count}: {len(store)} 个唯一 URL")
+            if failed:
+                # 只对未达标频道选源，排除当前 URL；没选出新源时保留旧源
+                Log(f"--- 重新选源: {', '.join(failed)} ---")
+                failedSet = set(failed)
+                current = CurrentUrls(existing, settings)
+                store = store.Rebuild(lambda chId, url: url if chId in failedSet and url not in current.get(chId, ()) else None)
+            opts = SelectOptions(settings)
+            if shard:
+                # 各分片停在不同位置，结果无法跨分片、跨区域比较，分片总是测完全部候选
+                opts["stopWhenDecided"] = False
+            with Metrics.Track("select"):
+                best = await SelectBestSources(client, store, history=history, ranking=ranking, **opts)
+        client.LogStats()
+        SaveBreakerState(client, settings)
+    # 输出中的 Master 地址替换为测速选中的变体（分片结果保留 Master 地址，各区域可能选中不同变体）
+    variants = client.variants if settings.get("输出变体地址", True) else {}
+    sampler.cancel()
+    WriteRunReport(settings)
+
+    if history:
+        Log(f"历史库更新: {history.Flush()} 个 URL")
+        history.Close()
+
+    # 生成 m3u 文件（分片模式写结果文件）
+    if shard:
+        WriteShardResults(resultFile or ShardDir / f"{region or 'default'}-{shard[0]}-of-{shard[1]}.json",
+                          region, shard[0], shard[1], store)
+    elif publish:
+        if failed is None:
+            PublishM3U(VariantSources(best, variants), WriteOutputs(best, ranking, store, settings, variants=variants))
+        elif failed:
+            # 未达标频道的新结果合并进多级输出，其余频道保留原有内容
+            PublishM3U(VariantSources({**existing, **best}, variants),
+                       WriteOutputs(best, ranking, store, settings, merge=True, variants=variants))
+        else:
+            PublishM3U(VariantSources(best, variants))
+        SaveRunState({"sinceFull": 0 if failed is None else sinceFull + 1,
+                      "lastRun": datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+
     Log(f"=== LiteIPTV 结束: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ===")
+    return best
 
 
-async def Main():
-    """主函数 - 单次执行模式（由 launchd 定时调度）"""
+class RedirectServer:
+    """重定向服务：为每个频道提供固定地址 /live/{chId}.m3u8，302 跳转到当前可用源
+    - /iptv.m3u 返回指向本服务的播放列表，客户端只需加载一次
+    - 后台每 checkInterval 秒用 LightCheck 检查各频道当前源，失败时按排名对备选并发 DeepVerify，
+      取排名最靠前的通过者立即切换，失效源移到末尾
+    - 每 rankInterval 秒用 TestUrl 重测前 backups 个备选，按延迟重新排序
+    - useVariants 时 Master 源跳转到测速选中的变体（与 iptv.m3u 中写的一致），没有选中变体时才跳转 Master
+    请求处理只做字典查找，不访问网络、不写日志
+    """
+
+    def __init__(self, client, host="0.0.0.0", port=8080, checkInterval=15, rankInterval=600, backups=5,
+                 useVariants=True):
+        self.client = client
+        self.useVariants = useVariants
+        self.host = host
+        self.port = port
+        self.checkInterval = checkInterval
+        self.rankInterval = rankInterval
+        self.backups = backups
+        self.active = {}  # {chId: 当前源}
+        self.ranks = {}  # {chId: [url, ...]} 备选排名，第一个为当前源
+        self.runner = None
+        self.tasks = []
+        self.failovers = 0
+
+    def Update(self, best, ranking=None, store=None):
+        """选源结果更新后合并排名：最优源、新排名、原有排名、候选池（未测），每个频道最多 20 个"""
+        ranking = ranking or {}
+        pool = store.ByChannel(20) if store else {}
+        for chId in Channels:
+            urls = []
+            if chId in best:
+                urls.append(best[chId])
+            urls += ranking.get(chId, [])
+            urls += self.ranks.get(chId, [])
+            urls += pool.get(chId, [])
+            urls = list(dict.fromkeys(urls))[:20]
+            if urls:
+                self.ranks[chId] = urls
+                self.active[chId] = urls[0]
+
+    async def HandleLive(self, request):
+        url = self.active.get(request.match_info["chId"])
+        if not url:
+            return web.Response(status=404)
+        chosen = self.client.variants.get(url) if self.useVariants else None
+        if chosen:
+            url = chosen[0]
+        return web.Response(status=302, headers={"Location": url, "Cache-Control": "no-store"})
+
+    async def HandlePlaylist(self, request):
+        base = f"{request.scheme}://{request.host}/live/"
+        content = BuildM3U({chId: f"{base}{quote(chId, safe='')}.m3u8" for chId in self.active})
+        return web.Response(text=content, content_type="audio/x-mpegurl")
+
+    async def HandleStatus(self, request):
+        return web.json_response({"failovers": self.failovers, "channels": self.ranks})
+
+    async def Failover(self, chId):
+        """当前源失效：按排名并发深度验证前几个备选，切换到排名最靠前的通过者"""
+        url = self.active[chId]
+        backups = [u for u in self.ranks[chId] if u != url][:3]
+        results = await asyncio.gather(*(DeepVerify(self.client, u, timeout=5) for u in backups))
+        for u, (passed, _) in zip(backups, results):
+            if passed:
+                # 失效源移到末尾，切换到的源排第一
+                rest = [x for x in self.ranks[chId] if x not in (u, url)]
+                self.ranks[chId] = [u] + rest + [url]
+                self.active[chId] = u
+                self.failovers += 1
+                Log(f"重定向切换: {chId} -> {GetSourceName(u)}")
+                return
+        # 全部失败：把失败的备选移到末尾，下一轮检查继续尝试其余备选
+        failed = [u for u, (passed, _) in zip(backups, results) if not passed]
+        self.ranks[chId] = [url] + [x for x in self.ranks[chId] if x != url and x not in failed] + failed
+
+    async def CheckLoop(self):
+        """后台健康检查当前源"""
+        async def checkOne(chId):
+            if not await LightCheck(self.client, self.active[chId]):
+                await self.Failover(chId)
+
+        while True:
+            await asyncio.sleep(self.checkInterval)
+            try:
+                await asyncio.gather(*(checkOne(chId) for chId in list(self.active)))
+            except Exception as e:
+                Log(f"重定向检查出错: {e}")
+
+    async def RankLoop(self):
+        """后台重测备选并按延迟排序（当前源保持第一）"""
+        async def rankOne(chId):
+            urls = [u for u in self.ranks[chId] if u != self.active[chId]]
+            head, tail = urls[:self.backups], urls[self.backups:]
+            results = await asyncio.gather(*(TestUrl(self.client, u) for u in head))
+            ok = sorted((r["ttfb"], u) for u, r in zip(head, results) if r)
+            bad = [u for u, r in zip(head, results) if not r]
+            # 重测期间可能已切换，当前源保持第一并去重
+            urls = [self.active[chId]] + [u for _, u in ok] + tail + bad
+            self.ranks[chId] = list(dict.fromkeys(urls))
+
+        while True:
+            await asyncio.sleep(self.rankInterval)
+            try:
+                await asyncio.gather(*(rankOne(chId) for chId in list(self.ranks) if chId in self.active))
+            except Exception as e:
+                Log(f"重定向重测出错: {e}")
+
+    async def Start(self):
+        app = web.Application()
+        app.router.add_get("/live/{chId}.m3u8", self.HandleLive)
+        app.router.add_get("/iptv.m3u", self.HandlePlaylist)
+        app.router.add_get("/status", self.HandleStatus)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port, backlog=1024).start()
+        self.tasks = [asyncio.ensure_future(self.CheckLoop()), asyncio.ensure_future(self.RankLoop())]
+        Log(f"重定向服务: http://{self.host}:{self.port}/iptv.m3u")
+
+    async def Stop(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.runner:
+            await self.runner.cleanup()
+
+
+class Daemon:
+    """守护模式：常驻进程内调度，只对降级的频道重新选源
+    - 每 checkInterval 秒轻量检查 iptv.m3u 中的当前 URL（播放列表 + 最新分片开头）
+    - 连续 degradeFails 次检查失败或延迟超限的频道视为降级，只对这些频道重新选源（排除当前 URL）
+    - 每 refreshInterval 秒重新抓取上游（有缓存时多为 304），更新候选池，不测速
+    - 每 fullInterval 秒全量选源一次，0 为不全量；启动时 iptv.m3u 不存在也会全量选源
+    连接池、运行缓存、主机并发状态和历史库在各轮之间复用；配置了 重定向服务端口 时同时运行 RedirectServer
+    """
+
+    def __init__(self):
+        self.cfg = None
+        self.settings = {}
+        self.candidates = CandidateStore()
+        self.best = {}
+        self.fails = {}  # {chId: 连续检查失败次数}
+        self.retryMissing = False  # 上游刷新后重试无源频道
+        self.server = None
+        self.nextCheck = 0
+        self.nextRefresh = 0
+        self.nextFull = 0
+
+    def Reload(self):
+        """重新读取配置（频道、上游源、调度间隔），配置错误时沿用上次配置"""
+        cfg = LoadConfig()
+        if not cfg or not LoadChannels(cfg):
+            return self.cfg is not None
+        self.cfg = cfg
+        self.settings = cfg.get("设置", {})
+        self.checkInterval = self.settings.get("守护检查间隔分钟", 5) * 60
+        self.refreshInterval = self.settings.get("守护上游刷新间隔分钟", 60) * 60
+        self.fullInterval = self.settings.get("守护全量选源间隔小时", 24) * 3600
+        self.degradeFails = self.settings.get("守护降级失败次数", 2)
+        self.slowLimit = self.settings.get("守护延迟阈值毫秒", 3000) / 1000
+        # 模块级参数（ffprobe 并发、测速预算、变体余量）随配置热加载
+        ApplySettings(self.settings)
+        return True
+
+    async def Check(self, client, history=None):
+        """轻量检查当前 URL，返回降级的频道列表"""
+        sem = asyncio.Semaphore(self.settings.get("最大并发数", 500))
+
+        async def checkOne(chId, url):
+            async with sem:
+                return chId, url, await LightCheck(client, url)
+
+        tasks = [checkOne(chId, url) for chId, url in self.best.items() if chId in Channels]
+        results = await asyncio.gather(*tasks)
+
+        # 无源频道只在候选池刷新后重试
+        degraded = [chId for chId in Channels if chId not in self.best] if self.retryMissing else []
+        self.retryMissing = False
+        for chId, url, r in results:
+            ok = r is not None and r["ttfb"] <= self.slowLimit
+            if history:
+                if r:
+                    history.Record(url, True, ttfb=r["ttfb"], speed=r["speed"])
+                else:
+                    history.Record(url, False)
+            if ok:
+                self.fails.pop(chId, None)
+                continue
+            self.fails[chId] = self.fails.get(chId, 0) + 1
+            if self.fails[chId] >= self.degradeFails:
+                degraded.append(chId)
+
+        failing = sum(1 for n in self.fails.values() if n > 0)
+        Log(f"轻量检查: {len(results)} 个频道，{failing} 个异常，{len(degraded)} 个需要重新选源")
+        return degraded
+
+    async def Tick(self, client, history=None, cache=None):
+        """执行到期的任务，源有变化时生成 iptv.m3u 并推送"""
+        global Metrics
+        Metrics = RunMetrics()
+        now = time.time()
+        before = dict(self.best)
+        selected = False
+
+        if now >= self.nextRefresh:
+            if self.Reload():
+                ConfigureClient(client, self.settings)
+            self.candidates = await CollectSources(client, self.cfg, cache)
+            self.nextRefresh = now + self.refreshInterval
+            self.retryMissing = True
+            if self.server:
+                self.server.Update(self.best, store=self.candidates)
+
+        opts = SelectOptions(self.settings)
+        ranking = {}
+        if now >= self.nextFull:
+            Log(f"=== 全量选源: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ===")
+            self.best.update(await SelectBestSources(client, self.candidates, history=history, ranking=ranking, **opts))
+            self.fails.clear()
+            selected = True
+            self.nextFull = now + self.fullInterval if self.fullInterval else float("inf")
+            self.nextCheck = now + self.checkInterval
+            client.LogStats()
+        elif now >= self.nextCheck:
+            degraded = await self.Check(client, history)
+            if degraded:
+                Log(f"--- 重新选源: {', '.join(degraded)} ---")
+                # 排除当前 URL（启动时读取的 iptv.m3u 可能是变体地址，一并排除其 Master），只在其余候选中选源；
+                # 没选出新源时保留旧源
+                degradedSet = set(degraded)
+                current = CurrentUrls(self.best, self.settings, client.variants)
+                sub = self.candidates.Rebuild(
+                    lambda chId, url: url if chId in degradedSet and url not in current.get(chId, ()) else None)
+                if len(sub):
+                    self.best.update(await SelectBestSources(client, sub, history=history, ranking=ranking, **opts))
+                    selected = True
+                for chId in degraded:
+                    self.fails.pop(chId, None)
+            self.nextCheck = now + self.checkInterval
+
+        if history:
+            history.Flush()
+        SaveBreakerState(client, self.settings)
+        if selected:
+            WriteRunReport(self.settings)
+        if self.server and ranking:
+            self.server.Update(self.best, ranking)
+
+        changed = [chId for chId in self.best if before.get(chId) != self.best[chId]]
+        if changed:
+            Log(f"源变化: {len(changed)} 个频道")
+            PublishM3U(VariantSources(self.best, client.variants) if self.settings.get("输出变体地址", True) else self.best)
+
+    async def Run(self):
+        """守护主循环，直到进程被终止"""
+        if not self.Reload():
+            return
+        history = OpenHistory(self.settings)
+        cache = UpstreamCache() if self.settings.get("启用上游缓存", True) else None
+
+        # 已有 iptv.m3u 时从轻量检查开始，不做全量选源
+        self.best = LoadExistingM3U("iptv.m3u")
+        now = time.time()
+        self.nextCheck = now
+        if self.best:
+            self.nextFull = now + self.fullInterval if self.fullInterval else float("inf")
+        Log(f"守护模式启动: 检查间隔 {self.checkInterval // 60} 分钟，上游刷新间隔 {self.refreshInterval // 60} 分钟，"
+            f"已有 {len(self.best)} 个频道")
+
+        try:
+            async with CreateClient(self.settings) as client:
+                port = self.settings.get("重定向服务端口", 0)
+                if port:
+                    self.server = RedirectServer(
+                        client, self.settings.get("重定向服务地址", "0.0.0.0"), port,
+                        self.settings.get("重定向检查间隔秒", 15),
+                        self.settings.get("重定向备选重测间隔分钟", 10) * 60,
+                        self.settings.get("重定向备选重测数", 5),
+                        self.settings.get("输出变体地址", True)
+                    )
+                    self.server.Update(self.best)
+                    await self.server.Start()
+                try:
+                    while True:
+                        # 日志超过 10 MB 时清空，避免常驻进程日志无限增长
+                        if LogFile.exists() and LogFile.stat().st_size > 10 * 1024 * 1024:
+                            LogFile.write_text("")
+                        try:
+                            await self.Tick(client, history, cache)
+                        except Exception as e:
+                            Log(f"执行出错: {e}")
+                        wait = min(self.nextCheck, self.nextRefresh, self.nextFull) - time.time()
+                        await asyncio.sleep(max(1, wait))
+                finally:
+                    if self.server:
+                        await self.server.Stop()
+        finally:
+            if history:
+                history.Close()
+
+
+async def Main(daemon=False, shard=None, region="", resultFile=None, full=False):
+    """主函数 - 默认单次执行模式（由 launchd 定时调度），daemon=True 时常驻运行，shard 为分片测速"""
     # 初始化日志目录
     LogDir.mkdir(parents=True, exist_ok=True)
     # 清空日志文件
     LogFile.write_text("")
 
+    if daemon:
+        await Daemon().Run()
+        return
+
     try:
-        await RunOnce()
+        await RunOnce(shard=shard, region=region, resultFile=resultFile, full=full)
     except Exception as e:
         Log(f"执行出错: {e}")
 
 
+def ParseArgs():
+    """解析命令行参数，无子命令时执行一次抓取测速"""
+    parser = argparse.ArgumentParser(description="LiteIPTV - 精简稳定的 CCTV 直播源")
+    parser.add_argument("--daemon", action="store_true", help="守护模式：常驻运行，只对降级的频道重新选源")
+    parser.add_argument("--full", action="store_true", help="跳过快速复检，直接全量选源")
+    sub = parser.add_subparsers(dest="command")
+
+    hist = sub.add_parser("history", help="查看或清理历史质量库")
+    hist.add_argument("--limit", type=int, default=30, help="显示条数")
+    hist.add_argument("--grep", help="只显示包含该关键字的 URL")
+    hist.add_argument("--worst", action="store_true", help="按分数升序显示")
+    hist.add_argument("--prune", type=float, metavar="DAYS", help="删除超过 DAYS 天未更新的记录")
+
+    probe = sub.add_parser("probe", help="分片测速：只测属于本分片的 URL，写入结果文件")
+    probe.add_argument("--shard", required=True, metavar="I/N", help="分片序号/分片总数，如 0/4")
+    probe.add_argument("--region", default="", help="区域名称，合并时按区域加权")
+    probe.add_argument("--out", help="结果文件路径（默认 Shards/<区域>-<I>-of-<N>.json）")
+
+    merge = sub.add_parser("merge", help="合并分片/区域结果，选源并生成 iptv.m3u")
+    merge.add_argument("files", nargs="+", help="结果文件")
+    merge.add_argument("--weight", action="append", default=[], metavar="区域=权重", help="区域权重，默认 1")
+    merge.add_argument("--no-push", action="store_true", help="只生成 iptv.m3u，不提交推送")
+
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    asyncio.run(Main())
+    args = ParseArgs()
+    if args.command == "history":
+        if args.prune is not None:
+            PruneHistory(args.prune)
+        else:
+            ShowHistory(args.limit, args.grep, args.worst)
+    elif args.command == "merge":
+        LogDir.mkdir(parents=True, exist_ok=True)
+        weights = {k: float(v) for k, v in (w.split("=", 1) for w in args.weight)}
+        RunMerge(args.files, weights, not args.no_push)
+    elif args.command == "probe":
+        index, count = (int(x) for x in args.shard.split("/"))
+        asyncio.run(Main(shard=(index, count), region=args.region, resultFile=args.out))
+    else:
+        try:
+            asyncio.run(Main(args.daemon, full=args.full))
+        except KeyboardInterrupt:
+            pass
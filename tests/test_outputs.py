@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""多级输出：部分频道重新选源时，其余频道的备选列表保持完整"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main
+
+
+def test_partial_reselection_keeps_backups(tmp_path, monkeypatch):
+    main.LoadChannels(main.LoadConfig())
+    monkeypatch.setattr(main, "RootDir", tmp_path)
+    monkeypatch.setattr(main, "Log", lambda msg: None)
+    settings = {"排名文件": ""}
+    store = main.CandidateStore()
+
+    main.WriteOutputs({"CCTV-1": "http://a/1"}, {"CCTV-1": ["http://a/1", "http://b/1", "http://c/1"]}, store, settings)
+    # 只对 CCTV-2 重新选源（快速复检的部分未达标）
+    main.WriteOutputs({"CCTV-2": "http://x/2"}, {"CCTV-2": ["http://x/2", "http://y/2"]}, store, settings, merge=True)
+
+    backups = main.LoadExistingM3U("iptv-backup.m3u", multi=True)
+    assert backups["CCTV-1"] == ["http://a/1", "http://b/1", "http://c/1"]
+    assert backups["CCTV-2"] == ["http://x/2", "http://y/2"]